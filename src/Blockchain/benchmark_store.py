@@ -0,0 +1,74 @@
+import argparse
+import hashlib
+import os
+import tempfile
+import time
+from block_store import BlockStore
+
+
+def make_block(index, prev_hash, entries):
+    # Same shape as Block.to_dict in block.py
+    timestamp = time.time()
+    records = [{"timestamp": timestamp, "data": f"reading {index}.{position}", "owner": "bench_pubkey",
+                "read_access": ["bench_pubkey"], "write_access": ["bench_pubkey"]}
+               for position in range(entries)]
+    block_hash = hashlib.sha256(f"{index}{prev_hash}{timestamp}".encode()).hexdigest()
+    return {"index": index, "prev_hash": prev_hash, "timestamp": timestamp,
+            "merkle_root": block_hash, "hash": block_hash, "entries": records}
+
+
+def grow(store, blocks, entries):
+    prev_hash = store[-1]["hash"] if len(store) else "0"
+    for index in range(len(store), blocks):
+        block = make_block(index, prev_hash, entries)
+        store.append(block)
+        prev_hash = block["hash"]
+
+
+def best_of(repeat, function):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - started)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time a restart of the block store, which only reads the index and the tip, "
+                    "against reading every block, for growing chains.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 300000],
+                        help="chain lengths in blocks")
+    parser.add_argument('--entries', type=int, default=8, help="entries per block")
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'chain.blocks')
+        print(f"{'blocks':>10} {'file MB':>9} {'restart ms':>11} {'random read ms':>15} {'full load ms':>13}")
+        for size in sorted(args.sizes):
+            store = BlockStore(filename, sync=False)
+            grow(store, size, args.entries)
+            store.close()
+
+            def restart():
+                BlockStore(filename).close()
+
+            def full_load():
+                store = BlockStore(filename)
+                for block in store:
+                    pass
+                store.close()
+
+            store = BlockStore(filename)
+            reads = range(0, size, max(1, size // 1000))
+            random_read = best_of(args.repeat, lambda: [store[index] for index in reads]) / len(reads)
+            store.close()
+            megabytes = os.path.getsize(filename) / 1e6
+            print(f"{size:>10} {megabytes:>9.1f} {best_of(args.repeat, restart) * 1000:>11.2f} "
+                  f"{random_read * 1000:>15.4f} {best_of(1, full_load) * 1000:>13.0f}")
+
+
+if __name__ == '__main__':
+    main()
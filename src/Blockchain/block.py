@@ -0,0 +1,61 @@
+import hashlib
+import json
+import time
+from merkle import merkle_root as compute_merkle_root
+
+
+class Entry:
+    # One write to the chain, blocks hold a batch of them
+    def __init__(self, data, owner, read_access, write_access, timestamp=None):
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.data = data
+        self.owner = owner  # Fingerprint of the writer's key
+        self.read_access = read_access
+        self.write_access = write_access
+        self.hash = self.calculate_hash()
+
+    def calculate_hash(self):
+        entry_str = json.dumps([self.timestamp, self.data, self.owner, self.read_access, self.write_access])
+        return hashlib.sha256(entry_str.encode()).hexdigest()
+
+    def to_dict(self):
+        return {"timestamp": self.timestamp, "data": self.data, "owner": self.owner,
+                "read_access": self.read_access, "write_access": self.write_access}
+
+    @classmethod
+    def from_dict(cls, record):
+        return cls(record["data"], record["owner"], record["read_access"], record["write_access"],
+                   record["timestamp"])
+
+
+class Block:
+    # merkle_root and block_hash are the stored values of a block read back
+    def __init__(self, index, prev_hash, entries, timestamp=None, merkle_root=None, block_hash=None):
+        self.index = index
+        self.prev_hash = prev_hash
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.entries = entries
+        if merkle_root is None:
+            merkle_root = compute_merkle_root([entry.hash for entry in entries])
+        self.merkle_root = merkle_root
+        # Readers of any entry, writers allowed after the last entry
+        self.read_access = list(dict.fromkeys(key for entry in entries for key in entry.read_access))
+        self.write_access = entries[-1].write_access
+        self.hash = self.calculate_hash() if block_hash is None else block_hash
+
+    def calculate_hash(self):
+        # The number of entries is hashed as well, the root alone does not fix it
+        block_str = f"{self.index}{self.prev_hash}{self.timestamp}{self.merkle_root}{len(self.entries)}"
+        return hashlib.sha256(block_str.encode()).hexdigest()
+
+    def to_dict(self):
+        return {"index": self.index, "prev_hash": self.prev_hash, "timestamp": self.timestamp,
+                "merkle_root": self.merkle_root, "hash": self.hash,
+                "entries": [entry.to_dict() for entry in self.entries]}
+
+    @classmethod
+    def from_dict(cls, record):
+        # Keep the stored hashes, so a changed block no longer matches them
+        return cls(record["index"], record["prev_hash"],
+                   [Entry.from_dict(entry) for entry in record["entries"]], record["timestamp"],
+                   record["merkle_root"], record["hash"])
@@ -0,0 +1,141 @@
+import json
+import mmap
+import os
+import threading
+from array import array
+
+
+class BlockStore:
+    """
+    Append-only block file with an offset index.
+
+    Every block is one JSON line in the block file. The index file next to it
+    (`<filename>.idx`) holds the byte offset of every block as 8 byte
+    integers, so a block is found by its index without reading the ones
+    before it. Reads go through a memory map of the block file.
+
+    Opening a store only reads the index and the last block. Blocks are
+    written before their offset, so after a crash the index is completed from
+    the blocks behind its last offset and a torn last block is cut off.
+
+    The store behaves like a list of blocks: len(store), store[index],
+    store[-1] and store.append(block).
+
+    Args:
+        filename: Block file, created when missing
+        encode: Turns a block into a JSON-serialisable dict
+        decode: Turns such a dict back into a block
+        sync: Whether append waits until the block is on disk
+        readonly: Open without repairing or appending, e.g. next to the node
+            that writes the store
+    """
+
+    def __init__(self, filename, encode=None, decode=None, sync=True, readonly=False):
+        self.filename = filename
+        self.sync = sync
+        self.index_filename = filename + '.idx'
+        self.encode = encode or (lambda block: block)
+        self.decode = decode or (lambda record: record)
+        self.lock = threading.Lock()
+        self.map = None
+        self.map_size = 0
+
+        mode = 'rb' if readonly else 'a+b'
+        self.file = open(filename, mode=mode)
+        self.index_file = open(self.index_filename, mode=mode)
+        self.offsets = array('Q')
+        index_size = os.fstat(self.index_file.fileno()).st_size
+        self.index_file.seek(0)
+        self.offsets.fromfile(self.index_file, index_size // self.offsets.itemsize)
+        if readonly:
+            # Only the blocks whose offset was written, those are complete
+            self.size = os.fstat(self.file.fileno()).st_size
+        else:
+            self.recover(index_size)
+        # Index and block of the tip, replaced together
+        self.tip = (len(self.offsets) - 1, self.read(len(self.offsets) - 1) if self.offsets else None)
+
+    def recover(self, index_size):
+        # Match the index with the block file after an interrupted append
+        size = os.fstat(self.file.fileno()).st_size
+        while self.offsets and self.offsets[-1] >= size:
+            self.offsets.pop()
+        start = self.offsets[-1] if self.offsets else 0
+        self.file.seek(start)
+        tail = self.file.read()
+        complete = tail.rfind(b'\n') + 1
+        if complete < len(tail):
+            # Torn last block without its newline
+            size = start + complete
+            self.file.truncate(size)
+            while self.offsets and self.offsets[-1] >= size:
+                self.offsets.pop()
+        indexed = len(self.offsets)
+        last_offset = self.offsets[-1] if self.offsets else -1
+        position = start
+        for line in tail[:complete].split(b'\n')[:-1]:
+            if position > last_offset:
+                self.offsets.append(position)
+            position += len(line) + 1
+        if len(self.offsets) != indexed or index_size != indexed * self.offsets.itemsize:
+            self.index_file.truncate(0)
+            self.offsets.tofile(self.index_file)
+            self.index_file.flush()
+        self.size = size
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self.offsets)
+        tip_index, tip = self.tip
+        if index == tip_index:
+            return tip
+        if not 0 <= index < len(self.offsets):
+            raise IndexError("block index out of range")
+        return self.read(index)
+
+    def __iter__(self):
+        for index in range(len(self.offsets)):
+            yield self[index]
+
+    def read(self, index):
+        start = self.offsets[index]
+        block_map = self.map
+        end = block_map.find(b'\n', start) if block_map is not None else -1
+        if end == -1:
+            block_map = self.remap()
+            end = block_map.find(b'\n', start)
+        return self.decode(json.loads(block_map[start:end]))
+
+    def remap(self):
+        # A memory map only covers the file size it was made with
+        with self.lock:
+            if self.map is None or self.map_size < self.size:
+                self.map = mmap.mmap(self.file.fileno(), self.size, access=mmap.ACCESS_READ)
+                self.map_size = self.size
+            return self.map
+
+    def append(self, block):
+        """
+        Write a block to the end of the store, durable when this returns
+        unless sync is off. Appends must not run concurrently.
+        """
+        line = json.dumps(self.encode(block), separators=(',', ':')).encode() + b'\n'
+        start = self.size
+        self.file.write(line)
+        self.file.flush()
+        if self.sync:
+            os.fsync(self.file.fileno())
+        array('Q', [start]).tofile(self.index_file)
+        self.index_file.flush()
+        self.size = start + len(line)
+        self.offsets.append(start)
+        self.tip = (len(self.offsets) - 1, block)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+        self.index_file.close()
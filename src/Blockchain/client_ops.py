@@ -24,11 +24,17 @@ class BlockchainClient:
         except requests.exceptions.ConnectionError:
             return {"error": "Node unavailable"}
 
-    def read_chain(self):
+    def read_chain(self, after_index=None, limit=None):
+        # Pass the X-Next-After-Index header of a page as after_index for the next
+        params = {"public_key": self.user.get_fingerprint()}
+        if after_index is not None:
+            params["after_index"] = after_index
+        if limit is not None:
+            params["limit"] = limit
         try:
             response = requests.get(
                 f"{self.node_url}/chain",
-                params={"public_key": self.user.get_public_key_str()}
+                params=params
             )
             return response.json()
         except requests.exceptions.ConnectionError:
@@ -39,6 +45,7 @@ def main_loop(username):
     from user_client import UserClient
     user = UserClient(username)
     client = BlockchainClient(user)
+    print(f"Your key fingerprint: {user.get_fingerprint()}")
 
     while True:
         print("\n1. Write to blockchain")
@@ -48,8 +55,8 @@ def main_loop(username):
 
         if choice == '1':
             data = input("Enter data: ")
-            read_access = input("Read access (comma-separated public keys): ").split(',')
-            write_access = input("Write access (comma-separated public keys): ").split(',')
+            read_access = input("Read access (comma-separated public keys or fingerprints): ").split(',')
+            write_access = input("Write access (comma-separated public keys or fingerprints): ").split(',')
             result = client.write_data(data, read_access, write_access)
             print("Result:", result)
 
@@ -57,7 +64,7 @@ def main_loop(username):
             chain = client.read_chain()
             print("\nAuthorized Blocks:")
             for block in chain:
-                print(f"Block {block['index']}: {block['data']}")
+                print(f"Block {block['index']}.{block['position']}: {block['data']}")
 
         elif choice == '3':
             break
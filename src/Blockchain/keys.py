@@ -0,0 +1,66 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from cryptography.hazmat.primitives import serialization
+
+PEM_PREFIX = "-----BEGIN"
+
+
+def fingerprint(public_key):
+    # Hex SHA-256 of the key's DER encoding, the same for any PEM formatting
+    der = public_key.public_bytes(
+        encoding=serialization.Encoding.DER,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+    return hashlib.sha256(der).hexdigest()
+
+
+class KeyCache:
+    """
+    Least recently used cache of the fingerprints of PEM public keys.
+
+    A PEM text is parsed once, so a client that sends the same PEM with
+    every request is only parsed again after max_size other keys were used.
+
+    Args:
+        max_size: Number of keys kept
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # PEM text -> fingerprint, in use order
+        self.fingerprints = OrderedDict()
+
+    def load(self, pem):
+        """
+        Fingerprint of a PEM public key, from the cache when it was seen before.
+
+        Raises:
+            ValueError: If pem is not a public key
+        """
+        with self.lock:
+            key_fingerprint = self.fingerprints.get(pem)
+            if key_fingerprint is not None:
+                self.fingerprints.move_to_end(pem)
+                return key_fingerprint
+
+        # Parsed outside the lock, two threads may parse the same key once
+        key_fingerprint = fingerprint(serialization.load_pem_public_key(pem.encode()))
+        with self.lock:
+            self.fingerprints[pem] = key_fingerprint
+            while len(self.fingerprints) > self.max_size:
+                self.fingerprints.popitem(last=False)
+        return key_fingerprint
+
+    def identity(self, key):
+        """
+        Fingerprint for a PEM key. Anything else, such as a fingerprint or a
+        name like the genesis block's "alice_pubkey", is returned unchanged.
+
+        Raises:
+            ValueError: If key looks like a PEM but is not a public key
+        """
+        if isinstance(key, str) and key.lstrip().startswith(PEM_PREFIX):
+            return self.load(key)
+        return key
@@ -0,0 +1,64 @@
+import hashlib
+
+# Leaves and inner nodes are hashed with different prefixes, so an inner
+# node can never be passed off as a leaf
+LEAF_PREFIX = b'\x00'
+NODE_PREFIX = b'\x01'
+
+
+def hash_leaf(leaf):
+    return hashlib.sha256(LEAF_PREFIX + leaf.encode()).hexdigest()
+
+
+def hash_pair(left, right):
+    return hashlib.sha256(NODE_PREFIX + (left + right).encode()).hexdigest()
+
+
+def merkle_levels(hashes):
+    # Every level of the tree, hashed leaves first. An odd node is moved up
+    # unchanged, pairing it with itself would give [a, b, c] and
+    # [a, b, c, c] the same root.
+    levels = [[hash_leaf(leaf) for leaf in hashes]]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        parents = [hash_pair(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            parents.append(level[-1])
+        levels.append(parents)
+    return levels
+
+
+def merkle_root(hashes):
+    """
+    Root of the Merkle tree over a list of hex digests, the digest of the
+    empty string for no hashes.
+    """
+    if not hashes:
+        return hashlib.sha256(b'').hexdigest()
+    return merkle_levels(hashes)[-1][0]
+
+
+def merkle_proof(hashes, position):
+    """
+    Sibling hashes from the leaf at position up to the root. Levels where
+    the node has no sibling and moves up unchanged add nothing.
+
+    Returns:
+        List of [sibling, side] pairs, side is 'left' or 'right' of the
+        running hash
+    """
+    proof = []
+    for level in merkle_levels(hashes)[:-1]:
+        sibling = position ^ 1
+        if sibling < len(level):
+            proof.append([level[sibling], 'left' if sibling < position else 'right'])
+        position //= 2
+    return proof
+
+
+def verify_proof(leaf, proof, root):
+    # Whether leaf is part of the tree with the given root
+    running = hash_leaf(leaf)
+    for sibling, side in proof:
+        running = hash_pair(sibling, running) if side == 'left' else hash_pair(running, sibling)
+    return running == root
@@ -0,0 +1,82 @@
+import json
+
+
+class ReaderIndex:
+    """
+    Indices of the blocks each reader may read, in chain order.
+
+    Built on the first read. For a chain in a BlockStore every indexed block
+    is also appended to `<filename>.readers` as one JSON line
+    [index, hash, read_access], so after a restart the index is loaded from
+    that file and only the blocks sealed after its last line are read. When
+    the hash of that line does not match the chain, e.g. because the block
+    file was replaced, the index is built from the blocks again.
+
+    Args:
+        chain: List of blocks or a BlockStore
+        filename: Block file of the BlockStore, None for a chain kept in memory
+    """
+
+    def __init__(self, chain, filename=None):
+        self.chain = chain
+        self.filename = filename + '.readers' if filename else None
+        self.file = None
+        # Reader fingerprint -> block indices, None until built
+        self.readable = None
+
+    def build(self):
+        # Call with no block being added
+        if self.readable is not None:
+            return
+        readable = {}
+        start = self.load(readable) if self.filename is not None else 0
+        if self.filename is not None:
+            self.file = open(self.filename, mode='ab')
+        self.readable = readable
+        for index in range(start, len(self.chain)):
+            self.add(self.chain[index])
+
+    def load(self, readable):
+        # Fill readable from the file, returns the number of blocks it covers
+        try:
+            file = open(self.filename, mode='rb')
+        except FileNotFoundError:
+            return 0
+        lines = []
+        with file:
+            end = 0
+            for line in file:
+                try:
+                    index, block_hash, keys = json.loads(line)
+                except (ValueError, TypeError):
+                    break
+                # Stop at a torn last line
+                if index != len(lines) or not line.endswith(b'\n'):
+                    break
+                end += len(line)
+                lines.append((block_hash, keys, end))
+
+        # The block file may have lost its tail after a crash
+        count = min(len(lines), len(self.chain))
+        if count and self.chain[count - 1].hash != lines[count - 1][0]:
+            count = 0
+        with open(self.filename, mode='r+b') as file:
+            file.truncate(lines[count - 1][2] if count else 0)
+        for index, (_, keys, _) in enumerate(lines[:count]):
+            for public_key in keys:
+                readable.setdefault(public_key, []).append(index)
+        return count
+
+    def add(self, block):
+        # Call in chain order, once the block is stored
+        if self.readable is None:
+            return
+        for public_key in block.read_access:
+            self.readable.setdefault(public_key, []).append(block.index)
+        if self.file is not None:
+            line = json.dumps([block.index, block.hash, block.read_access], separators=(',', ':'))
+            self.file.write(line.encode() + b'\n')
+            self.file.flush()
+
+    def get(self, public_key):
+        return self.readable.get(public_key, [])
@@ -1,98 +1,256 @@
 from flask import Flask, jsonify, request
-import hashlib
+import bisect
+import os
+import threading
 import time
-from cryptography.hazmat.primitives import serialization
+from concurrent.futures import Future
 from cryptography.hazmat.primitives.asymmetric import padding
 from cryptography.hazmat.primitives import hashes
+from block import Block, Entry
+from block_store import BlockStore
+from keys import KeyCache
+from merkle import merkle_proof
+from reader_index import ReaderIndex
+from verify import ChainAuditor
 
 app = Flask(__name__)
 
 
-class Block:
-    def __init__(self, index, prev_hash, data, owner, read_access, write_access):
-        self.index = index
-        self.prev_hash = prev_hash
-        self.timestamp = time.time()
-        self.data = data
-        self.owner = owner  # Store public key string
-        self.read_access = read_access
-        self.write_access = write_access
-        self.hash = self.calculate_hash()
-
-    def calculate_hash(self):
-        block_str = f"{self.index}{self.prev_hash}{self.timestamp}{self.data}{self.owner}"
-        return hashlib.sha256(block_str.encode()).hexdigest()
-
-
 class Blockchain:
-    def __init__(self):
-        self.chain = [self.create_genesis_block()]
+    """
+    Args:
+        filename: Block file of a BlockStore that keeps the chain across
+            restarts, None to keep it in memory only
+    """
+
+    def __init__(self, filename=None):
+        if filename is None:
+            self.chain = []
+        else:
+            self.chain = BlockStore(filename, encode=Block.to_dict, decode=Block.from_dict)
+        # Blocks each reader may read, built on the first read
+        self.readers = ReaderIndex(self.chain, filename)
+        self.lock = threading.Lock()
+        if not len(self.chain):
+            self.add_block(self.create_genesis_block())
+        self.auditor = ChainAuditor(self.chain, filename)
 
     def create_genesis_block(self):
         # Pre-configured genesis block with initial permissions
-        return Block(0, "0", "GENESIS", "system",
-                     ["alice_pubkey", "bob_pubkey"],  # Initial read access
-                     ["alice_pubkey"])  # Initial write access
+        return Block(0, "0", [Entry("GENESIS", "system",
+                                    ["alice_pubkey", "bob_pubkey"],  # Initial read access
+                                    ["alice_pubkey"])])  # Initial write access
 
     def add_block(self, new_block):
         # Simple validation (expand this in real implementation)
         self.chain.append(new_block)
+        self.readers.add(new_block)
         return new_block
 
+    def build_readable(self):
+        # Under the lock, so no block is sealed while the index is built
+        with self.lock:
+            self.readers.build()
+
+    def seal(self, entries):
+        # Append a block with the given entries to the tip
+        with self.lock:
+            last_block = self.chain[-1]
+            return self.add_block(Block(len(self.chain), last_block.hash, entries))
+
+    def readable_blocks(self, public_key, after_index=None, limit=None):
+        """
+        Blocks a key may read, in chain order.
+
+        Args:
+            public_key: Reader fingerprint as stored in the blocks' read_access
+            after_index: Only blocks with a higher index
+            limit: Maximum number of blocks, None for all
+
+        Returns:
+            Tuple of the blocks and the after_index of the next page, None
+            after the last page
+        """
+        if self.readers.readable is None:
+            self.build_readable()
+        indices = self.readers.get(public_key)
+        start = bisect.bisect_right(indices, after_index) if after_index is not None else 0
+        end = len(indices) if limit is None else min(start + limit, len(indices))
+        blocks = [self.chain[index] for index in indices[start:end]]
+        next_after = blocks[-1].index if blocks and end < len(indices) else None
+        return blocks, next_after
+
+
+class Mempool:
+    """
+    Pending writes, sealed together into one block.
+
+    A block is sealed as soon as max_entries writes are waiting, or max_wait
+    seconds after the first of them arrived. Each write gets a receipt with
+    the index of its block, its position in the block and the Merkle proof
+    linking its hash to the block's Merkle root.
+
+    Write permission is checked in arrival order: a write must be allowed by
+    the write_access of the write before it, pending or already sealed.
+
+    When a block cannot be sealed, the futures of its writes get the error.
+    """
+
+    def __init__(self, blockchain, max_entries=256, max_wait=0.2):
+        self.blockchain = blockchain
+        self.max_entries = max_entries
+        self.max_wait = max_wait
+        self.pending = []
+        self.first_arrival = None
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name="Mempool", daemon=True)
+        self.thread.start()
+
+    def write_access(self):
+        # Keys allowed to write next, call with the condition held
+        if self.pending:
+            return self.pending[-1][0].write_access
+        return self.blockchain.chain[-1].write_access
+
+    def submit(self, public_key, entry):
+        """
+        Queue an entry written by public_key.
+
+        Returns:
+            Future with the receipt, or None when the key may not write
+        """
+        future = Future()
+        with self.condition:
+            if public_key not in self.write_access():
+                return None
+            if not self.pending:
+                self.first_arrival = time.monotonic()
+            self.pending.append((entry, future))
+            self.condition.notify()
+        return future
 
-blockchain = Blockchain()
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                # Give concurrent writers a moment to join the block
+                deadline = self.first_arrival + self.max_wait
+                while len(self.pending) < self.max_entries:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                batch = self.pending[:self.max_entries]
+                del self.pending[:self.max_entries]
+                self.first_arrival = time.monotonic() if self.pending else None
+                # Sealed before new writes are checked against the pending ones
+                try:
+                    block = self.blockchain.seal([entry for entry, _ in batch])
+                except Exception as error:
+                    # The writers get the error, the thread keeps sealing
+                    for _, future in batch:
+                        future.set_exception(error)
+                    continue
+
+            leaves = [entry.hash for entry in block.entries]
+            for position, (entry, future) in enumerate(batch):
+                future.set_result({
+                    "index": block.index,
+                    "position": position,
+                    "hash": block.hash,
+                    "entry_hash": entry.hash,
+                    "merkle_root": block.merkle_root,
+                    "proof": merkle_proof(leaves, position)
+                })
+
+
+key_cache = KeyCache(max_size=int(os.environ.get('KEY_CACHE_SIZE', 1024)))
+blockchain = Blockchain(os.environ.get('BLOCK_STORE', 'chain.blocks'))
+mempool = Mempool(blockchain,
+                  max_entries=int(os.environ.get('BLOCK_MAX_ENTRIES', 256)),
+                  max_wait=float(os.environ.get('BLOCK_MAX_WAIT', 0.2)))
 
 
 @app.route('/chain', methods=['GET'])
 def get_chain():
-    public_key = request.args.get('public_key')
-    filtered_chain = []
+    # Paginate with ?after_index=&limit=, the X-Next-After-Index header holds
+    # the after_index of the next page. limit counts blocks.
+    # PEM or fingerprint of the reader
+    try:
+        public_key = key_cache.identity(request.args.get('public_key'))
+    except:
+        return jsonify({"error": "Invalid public key"}), 400
+    try:
+        after_index = int(request.args['after_index']) if request.args.get('after_index') else None
+        limit = int(request.args['limit']) if request.args.get('limit') else None
+        if limit is not None and limit < 1:
+            raise ValueError
+    except ValueError:
+        return jsonify({"error": "after_index and limit must be numbers, limit at least 1"}), 400
 
-    for block in blockchain.chain:
-        if public_key in block.read_access:
-            filtered_chain.append({
-                'index': block.index,
-                'data': block.data,
-                'owner': block.owner,
-                'timestamp': block.timestamp
-            })
-    return jsonify(filtered_chain)
+    blocks, next_after = blockchain.readable_blocks(public_key, after_index, limit)
+    filtered_chain = []
+    for block in blocks:
+        for position, entry in enumerate(block.entries):
+            if public_key in entry.read_access:
+                filtered_chain.append({
+                    'index': block.index,
+                    'position': position,
+                    'data': entry.data,
+                    'owner': entry.owner,
+                    'timestamp': entry.timestamp
+                })
+    response = jsonify(filtered_chain)
+    if next_after is not None:
+        response.headers['X-Next-After-Index'] = str(next_after)
+    return response
 
 
 @app.route('/add', methods=['POST'])
 def add_block():
     data = request.json
-    last_block = blockchain.chain[-1]
 
-    # Convert string back to public key
+    # The writer's PEM key, blocks store its fingerprint
     try:
-        public_key = serialization.load_pem_public_key(
-            data['public_key'].encode()
-        )
+        owner = key_cache.load(data['public_key'])
     except:
         return jsonify({"error": "Invalid public key"}), 400
 
-    # Verify write permission
-    if data['public_key'] not in last_block.write_access:
-        return jsonify({"error": "Write permission denied"}), 403
+    # Access lists may hold PEM keys or fingerprints
+    try:
+        read_access = [key_cache.identity(key) for key in data.get('read_access', [owner])]
+        write_access = [key_cache.identity(key) for key in data.get('write_access', [owner])]
+    except:
+        return jsonify({"error": "Invalid public key in read_access or write_access"}), 400
 
-    # Create new block
-    new_block = Block(
-        index=len(blockchain.chain),
-        prev_hash=last_block.hash,
+    entry = Entry(
         data=data['data'],
-        owner=data['public_key'],
-        read_access=data.get('read_access', [data['public_key']]),
-        write_access=data.get('write_access', [data['public_key']])
+        owner=owner,
+        read_access=read_access,
+        write_access=write_access
     )
 
-    blockchain.add_block(new_block)
-    return jsonify({
-        "status": "Block added",
-        "index": new_block.index,
-        "hash": new_block.hash
-    }), 201
+    # Verify write permission and wait until the entry's block is sealed
+    receipt = mempool.submit(owner, entry)
+    if receipt is None:
+        return jsonify({"error": "Write permission denied"}), 403
+
+    try:
+        return jsonify({"status": "Block added", **receipt.result()}), 201
+    except Exception as error:
+        return jsonify({"error": f"Block could not be stored: {error}"}), 500
+
+
+@app.route('/audit', methods=['GET'])
+def audit():
+    # Verifies the blocks added since the last audit, ?full=1 for every block
+    full = request.args.get('full', '').lower() in ('1', 'true', 'yes')
+    started = time.monotonic()
+    result = blockchain.auditor.audit(full=full)
+    result["seconds"] = round(time.monotonic() - started, 3)
+    return jsonify(result), 200 if result["valid"] else 409
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=5000, debug=True)
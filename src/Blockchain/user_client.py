@@ -2,6 +2,7 @@ from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import padding
 from cryptography.hazmat.primitives import hashes
+from keys import fingerprint
 import os
 
 
@@ -55,4 +56,8 @@ class UserClient:
         return self.public_key.public_bytes(
             encoding=serialization.Encoding.PEM,
             format=serialization.PublicFormat.SubjectPublicKeyInfo
-        ).decode()
\ No newline at end of file
+        ).decode()
+
+    def get_fingerprint(self):
+        # How the node refers to this key in blocks and access lists
+        return fingerprint(self.public_key)
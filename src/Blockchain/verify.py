@@ -0,0 +1,152 @@
+import json
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from block import Block
+from block_store import BlockStore
+from merkle import merkle_root
+
+# Cold verifications with more blocks than this are split over processes
+PARALLEL_BLOCKS = 20000
+# Most worker processes of a parallel audit
+MAX_WORKERS = int(os.environ.get('AUDIT_WORKERS', 4))
+
+
+def check_block(block, index, prev_hash):
+    # Reason the block is invalid, None when it is valid
+    if block.index != index:
+        return f"stored as block {block.index}"
+    if block.prev_hash != prev_hash:
+        return "prev_hash does not match the hash of the previous block"
+    if block.merkle_root != merkle_root([entry.hash for entry in block.entries]):
+        return "merkle_root does not match the entries"
+    if block.hash != block.calculate_hash():
+        return "hash does not match the block"
+    return None
+
+
+def verify_blocks(chain, start, end):
+    """
+    Check blocks start to end (exclusive) of a chain.
+
+    Args:
+        chain: List of blocks or a BlockStore
+
+    Returns:
+        None when all blocks are valid, else a dict with the index of the
+        first invalid block and the reason
+    """
+    prev_hash = chain[start - 1].hash if start > 0 else "0"
+    for index in range(start, end):
+        block = chain[index]
+        reason = check_block(block, index, prev_hash)
+        if reason is not None:
+            return {"index": index, "reason": reason}
+        prev_hash = block.hash
+    return None
+
+
+def verify_stored_range(filename, start, end):
+    # Runs in a pool worker, on its own read-only view of the store
+    store = BlockStore(filename, decode=Block.from_dict, readonly=True)
+    try:
+        return verify_blocks(store, start, end)
+    finally:
+        store.close()
+
+
+def verify_parallel(filename, start, end):
+    # Every range also checks its link to the block before it, so together
+    # the ranges cover the whole chain. Cold audits are rare, so each one
+    # gets its own pool and no idle workers are kept around.
+    workers = max(1, min(os.cpu_count() or 1, MAX_WORKERS))
+    size = max(1, -(-(end - start) // (workers * 4)))
+    # Fork where available, a spawned worker would re-run the Flask app module
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+    try:
+        futures = [executor.submit(verify_stored_range, filename, first, min(first + size, end))
+                   for first in range(start, end, size)]
+        for future in futures:
+            failure = future.result()
+            if failure is not None:
+                return failure
+        return None
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+class ChainAuditor:
+    """
+    Verifies a chain and remembers how far it is valid.
+
+    A checkpoint holds the length of the verified prefix and the hash of its
+    last block. The next audit only checks the blocks after it, and that the
+    last verified block still has the same hash. For a chain in a BlockStore
+    the checkpoint is kept in `<filename>.verified`, so it survives restarts.
+
+    Args:
+        chain: List of blocks or a BlockStore
+        filename: Block file of the BlockStore, None for a list
+    """
+
+    def __init__(self, chain, filename=None):
+        self.chain = chain
+        self.filename = filename
+        self.checkpoint_filename = filename + '.verified' if filename else None
+        self.checkpoint = self.load_checkpoint()
+        self.lock = threading.Lock()
+
+    def load_checkpoint(self):
+        if self.checkpoint_filename is None or not os.path.exists(self.checkpoint_filename):
+            return {"blocks": 0, "hash": None}
+        with open(self.checkpoint_filename) as file:
+            return json.load(file)
+
+    def save_checkpoint(self, checkpoint):
+        self.checkpoint = checkpoint
+        if self.checkpoint_filename is None:
+            return
+        tmp_filename = self.checkpoint_filename + '.tmp'
+        with open(tmp_filename, mode='w') as file:
+            json.dump(checkpoint, file)
+        os.replace(tmp_filename, self.checkpoint_filename)
+
+    def audit(self, full=False):
+        """
+        Verify the blocks added since the last checkpoint, or every block.
+
+        Each block must reproduce its stored hash and Merkle root, carry its
+        own index and point to the hash of the block before it.
+
+        Args:
+            full: Ignore the checkpoint and verify the chain from the start
+
+        Returns:
+            Dict with valid, the number of blocks, verified_from (the first
+            block checked) and failure (index and reason, or None)
+        """
+        with self.lock:
+            return self.run_audit(full)
+
+    def run_audit(self, full):
+        end = len(self.chain)
+        checkpoint = self.checkpoint
+        start = 0
+        if not full and 0 < checkpoint["blocks"] <= end:
+            if self.chain[checkpoint["blocks"] - 1].hash == checkpoint["hash"]:
+                start = checkpoint["blocks"]
+
+        if self.filename is not None and end - start > PARALLEL_BLOCKS:
+            failure = verify_parallel(self.filename, start, end)
+        else:
+            failure = verify_blocks(self.chain, start, end)
+
+        # The blocks before the first invalid one are still valid
+        verified = end if failure is None else failure["index"]
+        if verified != checkpoint["blocks"]:
+            self.save_checkpoint({"blocks": verified,
+                                  "hash": self.chain[verified - 1].hash if verified else None})
+        return {"valid": failure is None, "blocks": end, "verified_from": start, "failure": failure}
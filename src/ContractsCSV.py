@@ -1,6 +1,8 @@
 import csv
 import datetime
 import os
+from labels import parse_labels
+from reverse_csv import reverse_csv_reader
 
 
 class Ledger:
@@ -78,28 +80,23 @@ class Ledger:
         """
         data = "Not found"
 
-        with open(self.contracts_filename, mode='r') as file:
-            reader = csv.reader(file)
-            next(reader)  # Skip header row
-            reader = list(csv.reader(file))
-
-            for row in reversed(reader):
-                if len(row) >= 6:  # Ensure we have all columns
-                    timestamp, labels, sup, rec, amount, prio = row
-
-                    # Check if row matches search criteria
-                    matches_company = not company or (company == sup or company == rec)
-                    matches_supplier = not supplier or supplier == sup
-                    matches_receiver = not receiver or receiver == rec
-
-                    # Only return data if the requesting account has permission
-                    if matches_company and matches_supplier and matches_receiver:
-                        if account and (account in labels):
-                            # Convert amount to float for consistency
-                            data = row
-                            break
-                        else:
-                            print("No Permission")
+        for row in reverse_csv_reader(self.contracts_filename):
+            if len(row) >= 6:  # Ensure we have all columns
+                timestamp, labels, sup, rec, amount, prio = row
+
+                # Check if row matches search criteria
+                matches_company = not company or (company == sup or company == rec)
+                matches_supplier = not supplier or supplier == sup
+                matches_receiver = not receiver or receiver == rec
+
+                # Only return data if the requesting account has permission
+                if matches_company and matches_supplier and matches_receiver:
+                    if account and (account in parse_labels(labels)):
+                        # Convert amount to float for consistency
+                        data = row
+                        break
+                    else:
+                        print("No Permission")
 
         return data
 
@@ -107,27 +104,24 @@ class Ledger:
         """
         Export contracts data to a file with .csv extension
 
+        Rows are copied one at a time, so memory use does not grow with the
+        ledger. The output is written next to its destination and moved into
+        place, so exporting onto the contracts file itself is safe.
+
         Args:
             output_filename: The name of the output file (default: ledger_Contracts.csv)
         """
-        # Read data from the existing contracts CSV file
-        contracts_data = []
-        try:
-            with open(self.contracts_filename, mode='r', newline='') as file:
-                reader = csv.reader(file)
-                header = next(reader)  # Get header
-                contracts_data.append(header)  # Add header to data
-                for row in reader:
-                    contracts_data.append(row)
-        except FileNotFoundError:
-            # If the contracts file doesn't exist, use the default header
-            contracts_data.append(['timestamp', 'labels', 'Supplier', 'Receiver', 'amount'])
-
-        # Write data to the .csv file
-        with open(output_filename, mode='w', newline='') as file:
-            writer = csv.writer(file)
-            for row in contracts_data:
-                writer.writerow(row)
+        temporary = output_filename + '.tmp'
+        with open(temporary, mode='w', newline='') as output:
+            writer = csv.writer(output)
+            try:
+                with open(self.contracts_filename, mode='r', newline='') as file:
+                    # Header and rows, streamed from the existing contracts CSV file
+                    writer.writerows(csv.reader(file))
+            except FileNotFoundError:
+                # If the contracts file doesn't exist, use the default header
+                writer.writerow(['timestamp', 'labels', 'Supplier', 'Receiver', 'amount'])
+        os.replace(temporary, output_filename)
 
         print(f"Contracts data exported to {output_filename}")
 
@@ -0,0 +1,271 @@
+import logging
+import threading
+from collections.abc import Sequence
+import numpy as np
+from allocation import allocate
+
+
+logger = logging.getLogger(__name__)
+
+
+def parse_amount(key, row, amount):
+    """
+    Amount of a ledger row as a float, None when it is not a number. Such
+    rows are skipped by the calculations instead of failing every later
+    load of the ledger.
+    """
+    try:
+        return float(amount)
+    except ValueError:
+        logger.warning("Skipping %s row with a non-numeric amount: %s", key, row)
+        return None
+
+
+class GrowableArray:
+    # Append-only NumPy array that doubles its buffer when full
+    def __init__(self, dtype, fill=0):
+        self.fill = fill
+        self.buffer = np.full(16, fill, dtype=dtype)
+        self.size = 0
+
+    def reserve(self, size):
+        if size > len(self.buffer):
+            buffer = np.full(max(size, 2 * len(self.buffer)), self.fill, dtype=self.buffer.dtype)
+            buffer[:self.size] = self.buffer[:self.size]
+            self.buffer = buffer
+        self.size = max(self.size, size)
+
+    def append(self, value):
+        self.reserve(self.size + 1)
+        self.buffer[self.size - 1] = value
+
+    def view(self):
+        return self.buffer[:self.size]
+
+
+class Allocations(Sequence):
+    """
+    Allocation records of the contracts that got a share, read like a list
+    of dicts with the keys in KEYS.
+
+    The records are kept as columns and only turned into dicts when they are
+    read, so a result that is only looked up by column or company costs
+    little more than the allocation itself.
+    """
+
+    KEYS = ('supplier', 'receiver', 'requested', 'recommended vaccines to order from others',
+            'capacity', 'fill_percentage')
+
+    def __init__(self, names, suppliers, receivers, requested, fair, capacity, recommended):
+        self.names = names
+        self.suppliers = suppliers
+        self.receivers = receivers
+        self.requested = requested
+        self.fair = fair
+        self.capacity = capacity
+        self.recommended = recommended
+        self.records = None
+
+    def __len__(self):
+        return len(self.suppliers)
+
+    def __getitem__(self, index):
+        return self.list()[index]
+
+    def __iter__(self):
+        return iter(self.list())
+
+    def __eq__(self, other):
+        if isinstance(other, Allocations):
+            other = other.list()
+        return self.list() == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.list())
+
+    def list(self):
+        # Shared by every reader of the result, do not modify it
+        if self.records is None:
+            self.records = self.build(np.arange(len(self)))
+        return self.records
+
+    def build(self, indexes):
+        records = []
+        for supplier, receiver, requested_amount, fair_amount, storage_capacity, recommended in zip(
+                self.suppliers[indexes].tolist(),
+                self.receivers[indexes].tolist(),
+                self.requested[indexes].tolist(),
+                self.fair[indexes].tolist(),
+                self.capacity[indexes].tolist(),
+                self.recommended[indexes].tolist()):
+            records.append({
+                'supplier': self.names[supplier],
+                'receiver': self.names[receiver],
+                'requested': requested_amount,
+                'recommended vaccines to order from others': recommended,
+                'capacity': storage_capacity,
+                'fill_percentage': round((fair_amount / storage_capacity * 100 if storage_capacity > 0 else 0), 2)
+            })
+        return records
+
+    def recommended_by_receiver(self):
+        """
+        Recommended vaccines to order of the last allocated contract of every
+        receiver, without building the records.
+        """
+        # First and last contract of every receiver, in the order the
+        # receivers first appear
+        positions = np.arange(len(self.receivers))
+        first = np.full(len(self.names), len(positions))
+        last = np.full(len(self.names), -1)
+        np.minimum.at(first, self.receivers, positions)
+        np.maximum.at(last, self.receivers, positions)
+        receivers = np.flatnonzero(last >= 0)
+        receivers = receivers[np.argsort(first[receivers])]
+        return {self.names[receiver]: recommended for receiver, recommended in
+                zip(receivers.tolist(), self.recommended[last[receivers]].tolist())}
+
+    def where(self, key, company):
+        """
+        Records of the contracts a company is the 'supplier' or 'receiver' of.
+        """
+        column = self.suppliers if key == 'supplier' else self.receivers
+        try:
+            index = self.names.index(company)
+        except ValueError:
+            return []
+        return self.build(np.flatnonzero(column == index))
+
+
+class OutputAggregates:
+    """
+    Everything Ledger.calculate_output needs, kept up to date row by row.
+
+    Every company gets an index the first time it appears. Materials and
+    storage are kept per company index, vaccine contracts as arrays of
+    supplier index, receiver index and requested amount, so the allocation is
+    computed by allocation.allocate without reading the ledger files.
+
+    Rows must be added in ledger order.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.companies = {}
+        self.names = []
+        self.reset('data')
+        self.reset('contracts')
+
+    def reset(self, key):
+        if key == 'data':
+            self.materials = GrowableArray(np.float64)
+            self.storage = GrowableArray(np.float64)
+        else:
+            self.suppliers = GrowableArray(np.int64)
+            self.receivers = GrowableArray(np.int64)
+            self.requested = GrowableArray(np.float64)
+            self.total_requested = 0
+
+    def company(self, name):
+        index = self.companies.get(name)
+        if index is None:
+            index = self.companies[name] = len(self.names)
+            self.names.append(name)
+        return index
+
+    def rebuild(self, key, rows):
+        # Replace the state of one ledger with the given rows
+        with self.lock:
+            self.reset(key)
+            for row in rows:
+                self.add(key, row)
+
+    def add_row(self, key, row):
+        with self.lock:
+            self.add(key, row)
+
+    def add(self, key, row):
+        if key == 'data':
+            if len(row) >= 5:
+                _, labels_str, account, parameter, amount = row[:5]
+                if parameter == 'materials':
+                    values = self.materials
+                elif parameter == 'storage':
+                    values = self.storage
+                else:
+                    return
+                amount = parse_amount(key, row, amount)
+                if amount is None:
+                    return
+                index = self.company(account)
+                values.reserve(index + 1)
+                values.buffer[index] = amount
+        elif len(row) >= 6:
+            _, labels_str, supplier, receiver, parameter, value = row[:6]
+            if parameter == 'vaccines':
+                value = parse_amount(key, row, value)
+                if value is None:
+                    return
+                self.suppliers.append(self.company(supplier))
+                self.receivers.append(self.company(receiver))
+                self.requested.append(value)
+                self.total_requested += value
+
+    def arrays(self):
+        """
+        Copy of the current state as NumPy arrays.
+
+        Returns:
+            Dictionary with the company 'names', 'materials' and 'storage' per
+            company, the contract 'suppliers', 'receivers' and 'requested'
+            amounts and the 'total_requested'
+        """
+        with self.lock:
+            n_companies = len(self.names)
+            materials = np.zeros(n_companies)
+            materials[:self.materials.size] = self.materials.view()
+            storage = np.zeros(n_companies)
+            storage[:self.storage.size] = self.storage.view()
+            return {
+                'names': list(self.names),
+                'materials': materials,
+                'storage': storage,
+                'suppliers': self.suppliers.view().copy(),
+                'receivers': self.receivers.view().copy(),
+                'requested': self.requested.view().copy(),
+                'total_requested': self.total_requested
+            }
+
+    def result(self):
+        state = self.arrays()
+        names = state['names']
+        materials, storage = state['materials'], state['storage']
+        suppliers, receivers, requested = state['suppliers'], state['receivers'], state['requested']
+        total_requested = state['total_requested']
+
+        allocation = allocate(materials, storage, suppliers, receivers, requested)
+
+        # Records of the contracts that got a share, built when read
+        allocated = np.flatnonzero(allocation['allocated'])
+        results = Allocations(names, suppliers[allocated], receivers[allocated], requested[allocated],
+                              allocation['fair'][allocated], allocation['capacity'][allocated],
+                              allocation['recommended'][allocated])
+
+        # Totals over the companies in the vaccine contracts: the suppliers'
+        # materials and the receivers' storage
+        supplier_indexes = np.unique(suppliers)
+        return {
+            'available_materials': float(materials[supplier_indexes].sum()),
+            'total_storage': float(storage[np.unique(receivers)].sum()),
+            'total_requested': total_requested,
+            'suppliers': {
+                names[index]: {
+                    'available_materials': float(materials[index]),
+                    'total_storage': float(allocation['total_storage'][index]),
+                    'total_requested': float(allocation['total_requested'][index])
+                } for index in supplier_indexes.tolist()
+            },
+            'allocations': results
+        }
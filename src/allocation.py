@@ -0,0 +1,59 @@
+import numpy as np
+
+
+def distinct_pairs(suppliers, receivers, n_companies):
+    """
+    Distinct (supplier, receiver) pairs of the contracts, sorted by supplier.
+    """
+    pairs = np.unique(suppliers.astype(np.int64) * n_companies + receivers)
+    return pairs // n_companies, pairs % n_companies
+
+
+def allocate(materials, storage, suppliers, receivers, requested):
+    """
+    Split every supplier's materials over its contracts in proportion to the
+    receivers' storage, capped at what each contract requested.
+
+    A supplier's total storage is the storage of all distinct receivers it
+    has a contract with. Contracts of a supplier without storage or without
+    requested vaccines are not allocated.
+
+    materials and storage may carry leading dimensions (e.g. one row per
+    simulated scenario), the last axis is the company index.
+
+    Args:
+        materials: Available materials per company, shape (..., n_companies)
+        storage: Storage capacity per company, shape (..., n_companies)
+        suppliers: Supplier index per contract, shape (n_contracts,)
+        receivers: Receiver index per contract, shape (n_contracts,)
+        requested: Requested amount per contract, shape (n_contracts,)
+
+    Returns:
+        Dictionary with per contract 'fair' amount, 'capacity',
+        'recommended' amount to order from others and 'allocated' mask, and
+        per company 'total_storage' and 'total_requested' as supplier
+    """
+    n_companies = materials.shape[-1]
+    total_storage = np.zeros(np.broadcast_shapes(materials.shape, storage.shape))
+    if len(suppliers):
+        pair_suppliers, pair_receivers = distinct_pairs(suppliers, receivers, n_companies)
+        starts = np.flatnonzero(np.r_[True, pair_suppliers[1:] != pair_suppliers[:-1]])
+        total_storage[..., pair_suppliers[starts]] = np.add.reduceat(
+            storage[..., pair_receivers], starts, axis=-1)
+    total_requested = np.bincount(suppliers, weights=requested, minlength=n_companies)
+
+    capacity = storage[..., receivers]
+    contract_total_storage = total_storage[..., suppliers]
+    allocated = (contract_total_storage > 0) & (total_requested[suppliers] > 0)
+    # Calculate proportion based on storage capacity
+    with np.errstate(divide='ignore', invalid='ignore'):
+        proportion = np.where(allocated, capacity / contract_total_storage, 0.0)
+    fair = np.minimum(materials[..., suppliers] * proportion, requested)
+    return {
+        'fair': fair,
+        'capacity': capacity,
+        'recommended': capacity - np.round(fair),
+        'allocated': allocated,
+        'total_storage': total_storage,
+        'total_requested': total_requested
+    }
@@ -0,0 +1,159 @@
+import codecs
+import json
+import math
+
+DATA_FIELDS = ('labels', 'account', 'parameter', 'amount')
+CONTRACT_FIELDS = ('labels', 'supplier', 'receiver', 'parameter', 'value')
+
+
+def iter_records(stream, chunk_size=64 * 1024):
+    """
+    Stream-parse a request body holding a JSON array or NDJSON records.
+
+    The body is read in chunks and every record is decoded as soon as it is
+    complete, so the full body is never held in memory.
+
+    Args:
+        stream: Binary file-like object (e.g. Flask's request.stream)
+        chunk_size: Number of bytes read at a time
+
+    Returns:
+        Generator of (record, error) tuples, one of them is None. A syntax
+        error ends a JSON array, NDJSON continues with the next line.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    eof = False
+
+    def fill():
+        nonlocal buffer, eof
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            eof = True
+            buffer += text_decoder.decode(b'', final=True)
+        else:
+            buffer += text_decoder.decode(chunk)
+
+    # Find the first character to tell a JSON array from NDJSON
+    while not eof and not buffer.strip():
+        fill()
+    buffer = buffer.lstrip()
+    if not buffer:
+        return
+
+    if not buffer.startswith('['):
+        while True:
+            while '\n' in buffer:
+                line, buffer = buffer.split('\n', 1)
+                if line.strip():
+                    yield parse_line(line)
+            if eof:
+                if buffer.strip():
+                    yield parse_line(buffer)
+                return
+            fill()
+
+    position = 1
+    while True:
+        # Skip separators up to the next value or the end of the array
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if position < len(buffer) or eof:
+                break
+            fill()
+        if position >= len(buffer):
+            yield None, "Unterminated JSON array"
+            return
+        if buffer[position] == ']':
+            return
+        try:
+            record, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError as error:
+            if eof:
+                yield None, f"Invalid JSON: {error.msg}"
+                return
+            # The value is probably cut off at the end of the chunk
+            fill()
+            continue
+        if end == len(buffer) and not eof:
+            # A number could continue in the next chunk
+            fill()
+            continue
+        position = end
+        yield record, None
+        # Drop what was parsed so the buffer stays small
+        buffer = buffer[position:]
+        position = 0
+
+
+def parse_line(line):
+    try:
+        return json.loads(line), None
+    except json.JSONDecodeError as error:
+        return None, f"Invalid JSON: {error.msg}"
+
+
+def check_text(value, field):
+    """
+    Check a text field of an add request, or each label of a list. The
+    ledgers are read line by line, so no value may hold a line break.
+
+    Raises:
+        ValueError: When value contains a carriage return or newline
+    """
+    values = value if isinstance(value, (list, tuple, set, frozenset)) else [value]
+    for text in values:
+        if isinstance(text, str) and ('\n' in text or '\r' in text):
+            raise ValueError(f"{field} must not contain line breaks")
+    return value
+
+
+def check_number(value, field):
+    """
+    Check the amount or value of a single add request. Numbers and numeric
+    strings are accepted, as the ledger stores both as text.
+
+    Raises:
+        ValueError: When value is not a finite number
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError(f"{field} must be a number")
+    check_text(value, field)
+    try:
+        number = float(value)
+    except ValueError:
+        raise ValueError(f"{field} must be a number") from None
+    if not math.isfinite(number):
+        raise ValueError(f"{field} must be a number")
+    return value
+
+
+def validate_record(record, fields):
+    """
+    Check a bulk record and return its values in the order of fields.
+
+    Raises:
+        ValueError: Describing what is wrong with the record
+    """
+    if not isinstance(record, dict):
+        raise ValueError("Record must be a JSON object")
+    missing = [field for field in fields if field not in record]
+    if missing:
+        raise ValueError(f"Missing fields: {', '.join(missing)}")
+    for field in fields[1:-1]:
+        if not isinstance(record[field], str):
+            raise ValueError(f"{field} must be a string")
+        check_text(record[field], field)
+    labels = record['labels']
+    if not isinstance(labels, list) or not all(isinstance(label, str) for label in labels):
+        raise ValueError("labels must be a list of strings")
+    check_text(labels, 'labels')
+    # The last field is the numeric amount or value, the JSON parser also
+    # accepts NaN and Infinity
+    number = record[fields[-1]]
+    if not isinstance(number, (int, float)):
+        raise ValueError(f"{fields[-1]} must be a number")
+    check_number(number, fields[-1])
+    return [record[field] for field in fields]
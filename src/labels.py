@@ -0,0 +1,74 @@
+import re
+import threading
+
+# A quoted label inside a stored set or list, e.g. {'A', 'B'} or ['A', "B's"]
+QUOTED_LABEL = re.compile(r"'((?:[^'\\]|\\.)*)'|\"((?:[^\"\\]|\\.)*)\"")
+ESCAPE = re.compile(r"\\(.)")
+
+
+def format_labels(labels):
+    """
+    Store labels as a set literal with a fixed order, so the same set always
+    gives the same string. Labels are account names, other values such as
+    numbers are stored as their string.
+    """
+    labels = sorted({str(label) for label in labels})
+    if not labels:
+        return 'set()'
+    return '{' + ', '.join(repr(label) for label in labels) + '}'
+
+
+def parse_labels(text):
+    """
+    Read the labels column without evaluating it.
+
+    Understands the stored forms of the ledgers: set and list literals of
+    strings ("{'A'}", "['A', 'B']", "set()") and plain comma-separated names
+    ("A,B").
+
+    Returns:
+        frozenset of account names
+    """
+    text = text.strip()
+    if not text or text == 'set()':
+        return frozenset()
+    if text[0] in '{[(':
+        labels = (match.group(1) if match.group(1) is not None else match.group(2)
+                  for match in QUOTED_LABEL.finditer(text[1:-1]))
+        return frozenset(ESCAPE.sub(r'\1', label) for label in labels)
+    return frozenset(label.strip() for label in text.split(',') if label.strip())
+
+
+class LabelRegistry:
+    """
+    Interned label sets as bitsets over the known accounts.
+
+    Every account gets a bit the first time it shows up in a label set and
+    every distinct labels string is parsed once. A permission check is then a
+    dictionary lookup and a bit test.
+    """
+
+    def __init__(self):
+        self.bits = {}
+        self.masks = {}
+        self.lock = threading.Lock()
+
+    def mask(self, labels):
+        # Bitset of a stored labels string
+        mask = self.masks.get(labels)
+        if mask is None:
+            with self.lock:
+                mask = 0
+                for account in parse_labels(labels):
+                    bit = self.bits.setdefault(account, len(self.bits))
+                    mask |= 1 << bit
+                self.masks[labels] = mask
+        return mask
+
+    def allows(self, labels, account):
+        """
+        Check whether account is one of the labels of a row.
+        """
+        mask = self.mask(labels)
+        bit = self.bits.get(account)
+        return bit is not None and (mask >> bit) & 1 == 1
@@ -0,0 +1,1057 @@
+import bisect
+import csv
+import glob
+import json
+import os
+import sqlite3
+import sys
+import threading
+from functools import partial
+from ledger_writer import AppendWriter
+from reverse_csv import parse_row, reverse_csv_reader
+from rwlock import FileLock, LockSide, RWLock
+
+DATA_HEADER = ['timestamp', 'labels', 'account', 'parameter', 'amount']
+CONTRACTS_HEADER = ['timestamp', 'labels', 'Supplier', 'Receiver', 'amount', 'Priority']
+
+
+def csv_value(value):
+    # Same conversion csv.writer applies to non-string fields
+    return '' if value is None else str(value)
+
+
+def header_length(filename):
+    with open(filename, mode='rb') as file:
+        return len(file.readline())
+
+
+def snapshot_filename(filename):
+    return f"{os.path.splitext(filename)[0]}.snapshot.json"
+
+
+def segment_filename(filename, number):
+    return f"{os.path.splitext(filename)[0]}.{number:06d}.csv"
+
+
+def list_segments(filename):
+    # Archived segments of a ledger file, oldest first
+    return sorted(glob.glob(f"{glob.escape(os.path.splitext(filename)[0])}.[0-9][0-9][0-9][0-9][0-9][0-9].csv"))
+
+
+def compaction_key(key, row, position):
+    """
+    Rows with the same key are interchangeable for every query but the
+    newest, so compaction keeps only the newest row per key.
+
+    Lookups return the newest row an account may read, and whether it may
+    read it only depends on the labels. Data rows are therefore kept per
+    (account, parameter, labels) and contracts per (supplier, receiver,
+    parameter, labels). Vaccine contracts are all added up by the
+    allocation, so each of them keeps its own key.
+    """
+    if key == 'data':
+        return row[2], row[3], row[1]
+    if row[4] == 'vaccines':
+        return position
+    return row[2], row[3], row[4], row[1]
+
+
+class CsvStorage:
+    """
+    Ledger storage in two append-only CSV files (the default).
+
+    Every backend stores rows as lists of strings, in the column order of
+    DATA_HEADER and CONTRACTS_HEADER, and returns them the same way.
+
+    Appends go through one AppendWriter per file, flush_interval, flush_size
+    and fsync are passed on to it.
+
+    compact() writes a snapshot next to each file with the rows a query can
+    still return, see compaction_key. Opening the storage loads
+    the snapshot and only replays the rows after the byte offset it covers.
+
+    Objects in listeners are told about every row in ledger order with
+    row_added(key, row), and with ledger_reset(key) when a ledger was
+    cleared or compacted.
+
+    The storage can be shared by threads and by processes. Lookups run in
+    parallel under the read side of an RWLock and only read up to the end of
+    the last complete write. Writes, clears and compactions take the write
+    side plus a lock file next to the ledger, and first take over the rows
+    other processes appended in the meantime.
+    """
+
+    def __init__(self, data_filename, contracts_filename, flush_interval=0.0, flush_size=1000,
+                 fsync='none'):
+        self.data_filename = data_filename
+        self.contracts_filename = contracts_filename
+        self.filenames = {'data': data_filename, 'contracts': contracts_filename}
+        self.listeners = []
+
+        self.lock = RWLock()
+        self.file_locks = {key: FileLock(filename + '.lock') for key, filename in self.filenames.items()}
+        # Write side of a ledger: this process and then the lock file
+        self.write_locks = {key: LockSide(partial(self.lock_ledger, key), partial(self.unlock_ledger, key))
+                            for key in self.filenames}
+        # Size and inode of the files when this process last held them
+        self.ends = {}
+        self.inodes = {}
+
+        # Another process may be creating or appending to the files
+        with self.file_locks['data'], self.file_locks['contracts']:
+            # Create the CSV file with header if it doesn't exist
+            try:
+                with open(self.data_filename, mode='r') as file:
+                    pass
+            except FileNotFoundError:
+                self.create_ledger('data')
+            # Create the CSV file with header if it doesn't exist
+            try:
+                with open(self.contracts_filename, mode='r') as file:
+                    pass
+            except FileNotFoundError:
+                self.create_ledger('contracts')
+            self.stamp('data')
+            self.stamp('contracts')
+
+            # Compacted rows and the offset in the CSV file where the tail starts
+            self.snapshot_rows = {}
+            self.offsets = {}
+            self.segments = {}
+            self.load_snapshot('data')
+            self.load_snapshot('contracts')
+
+            # Newest data row per (company, parameter), built once and kept
+            # up to date by append_data
+            self.data_index = {}
+            self.build_data_index()
+
+            # Positions of the data rows per (company, parameter), sorted by
+            # timestamp. Built by the first history lookup, then kept up to date.
+            self.data_history = None
+            # Archived segment -> (inode, size, its rows per (company, parameter)
+            # as (timestamp, offset)). Segments do not change, so each is read once.
+            self.segment_history = {}
+
+            # Positions of contract rows, in ledger order, per lookup key. Rows in
+            # the CSV file are stored by byte offset, snapshot rows as -(i + 1).
+            self.contract_offsets = []
+            self.contracts_by_supplier = {}
+            self.contracts_by_receiver = {}
+            self.contracts_by_pair = {}
+            self.contracts_by_company = {}
+            self.build_contract_index()
+
+        # Long-lived appenders, they update the indexes as rows are written
+        self.data_writer = AppendWriter(self.data_filename, flush_interval, flush_size, fsync,
+                                        on_write=self.data_written, lock=self.write_locks['data'])
+        self.contracts_writer = AppendWriter(self.contracts_filename, flush_interval, flush_size,
+                                             fsync, on_write=self.contract_written,
+                                             lock=self.write_locks['contracts'])
+        self.writers = {'data': self.data_writer, 'contracts': self.contracts_writer}
+
+    def close(self):
+        self.data_writer.close()
+        self.contracts_writer.close()
+        for file_lock in self.file_locks.values():
+            file_lock.close()
+
+    def lock_ledger(self, key):
+        self.lock.acquire_write()
+        try:
+            self.file_locks[key].acquire()
+            try:
+                self.catch_up(key)
+            except BaseException:
+                self.file_locks[key].release()
+                raise
+        except BaseException:
+            self.lock.release_write()
+            raise
+
+    def unlock_ledger(self, key):
+        # Readers may now see everything written up to here
+        self.stamp(key)
+        self.file_locks[key].release()
+        self.lock.release_write()
+
+    def stamp(self, key):
+        stat = os.stat(self.filenames[key])
+        self.ends[key] = stat.st_size
+        self.inodes[key] = stat.st_ino
+
+    def catch_up(self, key):
+        """
+        Take over the rows other processes appended since this process last
+        held the ledger. A file replaced by a clear or compaction elsewhere is
+        reloaded completely. Needs the write side of the ledger.
+        """
+        filename = self.filenames[key]
+        stat = os.stat(filename)
+        if stat.st_ino != self.inodes[key]:
+            self.stamp(key)
+            self.load_snapshot(key)
+            if key == 'data':
+                self.build_data_index()
+            else:
+                self.build_contract_index()
+            self.writers[key].reopen()
+            self.notify_reset(key)
+        elif stat.st_size > self.ends[key]:
+            width, written = (5, self.data_written) if key == 'data' else (6, self.contract_written)
+            with open(filename, mode='rb') as file:
+                offset = file.seek(self.ends[key])
+                for line in file:
+                    row = parse_row(line)
+                    if len(row) >= width:
+                        written(row, offset)
+                    offset += len(line)
+            self.ends[key] = offset
+
+    def refresh(self, key=None):
+        """
+        Take over the rows other processes wrote to one ledger, or to both
+        when key is None.
+        """
+        for key in (key,) if key else self.filenames:
+            stat = os.stat(self.filenames[key])
+            if stat.st_size != self.ends[key] or stat.st_ino != self.inodes[key]:
+                with self.write_locks[key]:
+                    pass
+
+    def create_ledger(self, key):
+        match key:
+            case "data":
+                filename = self.data_filename
+                header = DATA_HEADER
+            case "contracts":
+                filename = self.contracts_filename
+                header = CONTRACTS_HEADER
+        with open(filename, mode='w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(header)
+
+    def clear(self, key):
+        filename, writer = self.filenames[key], self.writers[key]
+
+        # Keep the appender from writing while the file is reset
+        with writer.lock:
+            with open(filename, mode='rb') as file:
+                # Read the first line (header)
+                header = file.readline()
+
+            # Replace the file with one holding only the header, readers and
+            # other processes still holding the old file see it change
+            temporary = filename + '.tmp'
+            with open(temporary, mode='wb') as file:
+                file.write(header)
+            os.replace(temporary, filename)
+            writer.reopen()
+
+            self.snapshot_rows[key] = []
+            self.offsets[key] = header_length(filename)
+            # The archived history goes with the rows, export and the full
+            # recompute of calculate_output read it
+            for segment in self.segments[key]:
+                if os.path.exists(segment):
+                    os.remove(segment)
+            self.segments[key] = []
+            # An old snapshot would bring the cleared rows back on restart
+            if os.path.exists(snapshot_filename(filename)):
+                self.write_snapshot(key)
+
+            if key == 'data':
+                self.data_index = {}
+                self.data_history = None
+                self.segment_history = {}
+            else:
+                self.build_contract_index()
+            self.notify_reset(key)
+
+    def notify_reset(self, key):
+        for listener in self.listeners:
+            listener.ledger_reset(key)
+
+    def data_written(self, row, offset):
+        # Called by the appender in file order
+        self.index_data(row)
+        if self.data_history is not None:
+            self.index_history((row[2], row[3]), row[0], offset)
+        for listener in self.listeners:
+            listener.row_added('data', row)
+
+    def contract_written(self, row, offset):
+        self.index_contract(row, offset)
+        for listener in self.listeners:
+            listener.row_added('contracts', row)
+
+    def load_snapshot(self, key):
+        filename = self.filenames[key]
+        try:
+            with open(snapshot_filename(filename), mode='r') as file:
+                snapshot = json.load(file)
+        except FileNotFoundError:
+            snapshot = {'offset': None, 'segments': [], 'rows': []}
+
+        rows = snapshot['rows']
+        offset = snapshot['offset']
+        # Segments archived after the snapshot was written, when a compaction
+        # was interrupted. Their rows are not in the snapshot yet.
+        for segment in list_segments(filename):
+            if segment not in snapshot['segments']:
+                rows += self.read_rows(segment, header_length(segment))
+                snapshot['segments'].append(segment)
+                offset = None
+        self.snapshot_rows[key] = rows
+        self.offsets[key] = offset if offset is not None else header_length(filename)
+        self.segments[key] = snapshot['segments']
+
+    def write_snapshot(self, key):
+        filename = self.filenames[key]
+        snapshot = {
+            'offset': self.offsets[key],
+            'segments': self.segments[key],
+            'rows': self.snapshot_rows[key]
+        }
+        temporary = snapshot_filename(filename) + '.tmp'
+        with open(temporary, mode='w') as file:
+            json.dump(snapshot, file)
+        os.replace(temporary, snapshot_filename(filename))
+
+    def compact(self, key=None, archive=True):
+        """
+        Snapshot the rows any query can still return, see compaction_key.
+
+        Args:
+            key: 'data', 'contracts' or None for both ledgers
+            archive: Move the covered rows to a numbered segment file next to
+                     the ledger, which then only holds the tail. Without it the
+                     snapshot records the offset it covers in the same file.
+
+        Returns:
+            Number of rows kept in the snapshot per ledger
+        """
+        if key is None:
+            return {key: self.compact(key, archive)[key] for key in ('data', 'contracts')}
+
+        filename, writer = self.filenames[key], self.writers[key]
+        width = 5 if key == 'data' else 6
+        with writer.lock:
+            # Newest row per key, in the order they were written
+            latest = {}
+            for position, row in enumerate(self.iter_rows(key)):
+                if len(row) >= width:
+                    row_key = compaction_key(key, row, position)
+                    latest.pop(row_key, None)
+                    latest[row_key] = row
+
+            if archive:
+                segment = segment_filename(filename, len(list_segments(filename)) + 1)
+                with open(filename, mode='rb') as file:
+                    header = file.readline()
+                os.replace(filename, segment)
+                with open(filename, mode='wb') as file:
+                    file.write(header)
+                writer.reopen()
+                self.segments[key] = self.segments[key] + [segment]
+                self.offsets[key] = len(header)
+            else:
+                self.offsets[key] = os.path.getsize(filename)
+            self.snapshot_rows[key] = list(latest.values())
+            self.write_snapshot(key)
+
+            if key == 'data':
+                self.build_data_index()
+            else:
+                self.build_contract_index()
+            self.notify_reset(key)
+        return {key: len(latest)}
+
+    def read_rows(self, filename, offset):
+        # Rows of a CSV file from a byte offset on
+        with open(filename, mode='rb') as file:
+            file.seek(offset)
+            return [parse_row(line) for line in file]
+
+    def iter_rows(self, key):
+        """
+        Yield all rows of a ledger: the snapshot first, then the tail.
+        """
+        with self.lock.reader:
+            rows, offset, end = self.snapshot_rows[key], self.offsets[key], self.ends[key]
+            # The open file stays the same when the ledger is replaced meanwhile
+            file = open(self.filenames[key], mode='rb')
+        yield from rows
+        with file:
+            file.seek(offset)
+            for line in file:
+                if offset >= end:
+                    break
+                offset += len(line)
+                yield parse_row(line)
+
+    def build_data_index(self):
+        """
+        Rebuild the (company, parameter) -> newest row index from the data ledger.
+        """
+        self.data_index = {}
+        self.data_history = None
+        for row in self.iter_rows('data'):
+            if len(row) >= 5:
+                self.index_data(row)
+
+    def index_data(self, row, offset=None):
+        self.data_index[(row[2], row[3])] = row
+
+    def build_data_history(self):
+        """
+        Build the (company, parameter) -> (timestamps, positions) index of the
+        data ledger over every row ever written: the archived segments and the
+        whole ledger file, also the part a snapshot covers. Positions are byte
+        offsets in the file, (segment, offset) in the archived segments.
+        """
+        # No rows are appended while the file is read
+        with self.write_locks['data']:
+            if self.data_history is not None:
+                return
+            self.data_history = {}
+            for number, segment in enumerate(self.segments['data']):
+                for pair, entries in self.read_segment_history(segment).items():
+                    for timestamp, offset in entries:
+                        self.index_history(pair, timestamp, (number, offset))
+            with open(self.data_filename, mode='rb') as file:
+                offset = len(file.readline())
+                for line in file:
+                    row = parse_row(line)
+                    if len(row) >= 5:
+                        self.index_history((row[2], row[3]), row[0], offset)
+                    offset += len(line)
+
+    def read_segment_history(self, segment):
+        # Rows of an archived segment per (company, parameter), read once
+        try:
+            stat = os.stat(segment)
+        except FileNotFoundError:
+            return {}
+        cached = self.segment_history.get(segment)
+        if cached is not None and cached[:2] == (stat.st_ino, stat.st_size):
+            return cached[2]
+        history = {}
+        with open(segment, mode='rb') as file:
+            offset = len(file.readline())
+            for line in file:
+                row = parse_row(line)
+                if len(row) >= 5:
+                    history.setdefault((row[2], row[3]), []).append((row[0], offset))
+                offset += len(line)
+        self.segment_history[segment] = (stat.st_ino, stat.st_size, history)
+        return history
+
+    def index_history(self, pair, timestamp, position):
+        timestamps, positions = self.data_history.setdefault(pair, ([], []))
+        # Rows normally arrive in time order, so this is nearly always an append
+        index = bisect.bisect_right(timestamps, timestamp)
+        timestamps.insert(index, timestamp)
+        positions.insert(index, position)
+
+    def build_contract_index(self):
+        """
+        Rebuild the supplier, receiver, (supplier, receiver) and company
+        indexes from the contracts ledger.
+        """
+        self.contract_offsets = []
+        self.contracts_by_supplier = {}
+        self.contracts_by_receiver = {}
+        self.contracts_by_pair = {}
+        self.contracts_by_company = {}
+        for position, row in enumerate(self.snapshot_rows['contracts']):
+            if len(row) >= 6:
+                self.index_contract(row, -(position + 1))
+        with open(self.contracts_filename, mode='rb') as file:
+            offset = self.offsets['contracts']
+            file.seek(offset)
+            for line in file:
+                row = parse_row(line)
+                if len(row) >= 6:
+                    self.index_contract(row, offset)
+                offset += len(line)
+
+    def index_contract(self, row, offset):
+        supplier, receiver = row[2], row[3]
+        self.contract_offsets.append(offset)
+        self.contracts_by_supplier.setdefault(supplier, []).append(offset)
+        self.contracts_by_receiver.setdefault(receiver, []).append(offset)
+        self.contracts_by_pair.setdefault((supplier, receiver), []).append(offset)
+        self.contracts_by_company.setdefault(supplier, []).append(offset)
+        if receiver != supplier:
+            self.contracts_by_company.setdefault(receiver, []).append(offset)
+
+    def read_rows_at(self, key, offsets):
+        """
+        Rows at byte offsets of the ledger file, snapshot positions -(i + 1)
+        or (segment, offset) in the archived segments.
+
+        Call with the read side held, the rows themselves are read after it
+        was released.
+        """
+        snapshot_rows, segments = self.snapshot_rows[key], list(self.segments[key])
+        file = open(self.filenames[key], mode='rb')
+        return self.read_positions(file, snapshot_rows, segments, offsets)
+
+    def read_positions(self, file, snapshot_rows, segments, offsets):
+        parts = {}
+        try:
+            for offset in offsets:
+                if isinstance(offset, tuple):
+                    number, offset = offset
+                    if number not in parts:
+                        parts[number] = open(segments[number], mode='rb')
+                    parts[number].seek(offset)
+                    yield parse_row(parts[number].readline())
+                elif offset < 0:
+                    yield snapshot_rows[-offset - 1]
+                else:
+                    file.seek(offset)
+                    yield parse_row(file.readline())
+        finally:
+            file.close()
+            for part in parts.values():
+                part.close()
+
+    def append_data(self, row):
+        # Keep the index in the same string form the csv reader returns
+        row = [csv_value(value) for value in row]
+        self.data_writer.write(row)
+        return row
+
+    def append_contract(self, row):
+        row = [csv_value(value) for value in row]
+        self.contracts_writer.write(row)
+        return row
+
+    def append_data_many(self, rows):
+        # Queued together, so the writer stores them in as few writes as possible
+        rows = [[csv_value(value) for value in row] for row in rows]
+        for future in self.data_writer.append_many(rows):
+            future.result()
+        return rows
+
+    def append_contracts_many(self, rows):
+        rows = [[csv_value(value) for value in row] for row in rows]
+        for future in self.contracts_writer.append_many(rows):
+            future.result()
+        return rows
+
+    def find_data(self, company, parameter):
+        """
+        Yield the data rows of a company parameter, newest first.
+        """
+        self.refresh('data')
+        with self.lock.reader:
+            newest = self.data_index.get((company, parameter))
+            snapshot_rows, start, end = self.snapshot_rows['data'], self.offsets['data'], self.ends['data']
+            inode = self.inodes['data']
+        if newest is None:
+            return
+        yield newest
+        # Older rows are rarely needed, only then fall back to a scan of the
+        # tail and the compacted row
+        file = open(self.data_filename, mode='rb')
+        if os.fstat(file.fileno()).st_ino != inode:
+            # Cleared or compacted since, the older rows are gone
+            file.close()
+            return
+        matches = (row for row in reverse_csv_reader(file, start=start, end=end)
+                   if len(row) >= 5 and row[2] == company and row[3] == parameter)
+        older = [row for row in snapshot_rows
+                 if len(row) >= 5 and row[2] == company and row[3] == parameter]
+        next(matches, None)  # Same row as the index entry
+        yield from matches
+        # A snapshot keeps one row per labels value, newest last
+        for row in reversed(older):
+            if row is not newest:
+                yield row
+
+    def find_history(self, company, parameter, start=None, end=None, offset=0, limit=None,
+                     newest_first=False):
+        """
+        Yield the data rows of a company parameter with a timestamp between
+        start and end (both inclusive, None for no bound), oldest first.
+
+        Args:
+            offset: Number of matching rows to skip
+            limit: Maximum number of rows, None for all
+            newest_first: Yield the newest matching row first
+        """
+        self.refresh('data')
+        if self.data_history is None:
+            self.build_data_history()
+        with self.lock.reader:
+            timestamps, positions = self.data_history.get((company, parameter), ([], []))
+            low = bisect.bisect_left(timestamps, start) if start is not None else 0
+            high = bisect.bisect_right(timestamps, end) if end is not None else len(timestamps)
+            if newest_first:
+                selected = positions[low:high][::-1]
+            else:
+                selected = positions[low:high]
+            stop = offset + limit if limit is not None else None
+            return self.read_rows_at('data', selected[offset:stop])
+
+    def find_contracts(self, company=None, supplier=None, receiver=None):
+        """
+        Yield the contract rows matching all given filters, newest first.
+        """
+        self.refresh('contracts')
+        with self.lock.reader:
+            # Only visit the rows of the most selective index
+            if supplier and receiver:
+                offsets = self.contracts_by_pair.get((supplier, receiver), [])
+            elif supplier:
+                offsets = self.contracts_by_supplier.get(supplier, [])
+            elif receiver:
+                offsets = self.contracts_by_receiver.get(receiver, [])
+            elif company:
+                offsets = self.contracts_by_company.get(company, [])
+            else:
+                offsets = self.contract_offsets
+            # Newest first
+            rows = self.read_rows_at('contracts', offsets[::-1])
+
+        for row in rows:
+            if len(row) >= 6:  # Ensure we have all columns
+                sup, rec = row[2], row[3]
+                if ((not company or company == sup or company == rec)
+                        and (not supplier or supplier == sup)
+                        and (not receiver or receiver == rec)):
+                    yield row
+
+    def export(self, key, since=None):
+        """
+        All rows ever written to a ledger, archived segments included, in the
+        order they were written.
+
+        Args:
+            key: 'data' or 'contracts'
+            since: Checkpoint of an earlier export, only the rows written
+                   after it are returned
+
+        Returns:
+            Tuple of a row iterator and the checkpoint after its last row, as
+            'segment:offset': the number of archived segments and the byte
+            offset in the ledger file
+
+        Raises:
+            ValueError: When since is not a checkpoint
+        """
+        segment, offset = 0, None
+        if since is not None:
+            parts = since.split(':')
+            if len(parts) != 2 or not all(part.isdigit() for part in parts):
+                raise ValueError(f"Checkpoint {since} is not part of this ledger")
+            segment, offset = int(parts[0]), int(parts[1])
+
+        self.refresh(key)
+        with self.lock.reader:
+            segments, end = list(self.segments[key]), self.ends[key]
+            # The open file stays the same when the ledger is replaced meanwhile
+            file = open(self.filenames[key], mode='rb')
+        if segment > len(segments) or (segment == len(segments) and offset is not None and offset > end):
+            # The ledger was cleared since, start over
+            segment, offset = 0, None
+        return self.read_export(file, segments, segment, offset, end), f"{len(segments)}:{end}"
+
+    def read_export(self, file, segments, segment, offset, end):
+        with file:
+            for number in range(segment, len(segments)):
+                with open(segments[number], mode='rb') as part:
+                    header = part.readline()
+                    part.seek(offset if number == segment and offset is not None else len(header))
+                    for line in part:
+                        yield parse_row(line)
+            header = file.readline()
+            position = offset if segment == len(segments) and offset is not None else len(header)
+            file.seek(position)
+            for line in file:
+                if position >= end:
+                    break
+                position += len(line)
+                yield parse_row(line)
+
+    def iter_data(self):
+        self.refresh('data')
+        return self.iter_rows('data')
+
+    def iter_contracts(self):
+        self.refresh('contracts')
+        return self.iter_rows('contracts')
+
+
+class SqliteStorage:
+    """
+    Ledger storage in an SQLite database in WAL mode.
+
+    Readers do not block the writer and lookups go through the
+    (account, parameter, timestamp) and (supplier, receiver) indexes. All
+    queries use fixed SQL text so sqlite3 reuses the prepared statements.
+
+    Several processes may share the database. Listeners are also told about
+    the rows other processes inserted, on the next write or refresh().
+
+    Args:
+        filename: Database file
+        synchronous: SQLite synchronous setting, 'NORMAL' or 'FULL' to sync
+                     every commit to disk
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS data (
+            id INTEGER PRIMARY KEY,
+            timestamp TEXT, labels TEXT, account TEXT, parameter TEXT, amount TEXT
+        );
+        CREATE INDEX IF NOT EXISTS data_account_parameter_timestamp
+            ON data (account, parameter, timestamp);
+        CREATE TABLE IF NOT EXISTS contracts (
+            id INTEGER PRIMARY KEY,
+            timestamp TEXT, labels TEXT, supplier TEXT, receiver TEXT, parameter TEXT, value TEXT
+        );
+        CREATE INDEX IF NOT EXISTS contracts_supplier_receiver
+            ON contracts (supplier, receiver);
+        CREATE INDEX IF NOT EXISTS contracts_receiver
+            ON contracts (receiver);
+        CREATE TABLE IF NOT EXISTS imported (
+            filename TEXT PRIMARY KEY, offset INTEGER, inode INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS resets (
+            ledger TEXT PRIMARY KEY, count INTEGER
+        );
+    """
+    DATA_COLUMNS = "timestamp, labels, account, parameter, amount"
+    CONTRACT_COLUMNS = "timestamp, labels, supplier, receiver, parameter, value"
+
+    def __init__(self, filename, synchronous='NORMAL'):
+        if synchronous not in ('NORMAL', 'FULL'):
+            raise ValueError("synchronous must be 'NORMAL' or 'FULL'")
+        self.filename = filename
+        self.synchronous = synchronous
+        self.listeners = []
+        # Writes are serialised so listeners see rows in id order. Listeners
+        # may read the ledger while they are notified.
+        self.write_lock = threading.RLock()
+        # sqlite3 connections may only be used by the thread that made them
+        self.local = threading.local()
+        connection = self.connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(self.SCHEMA)
+        # Databases made before the import stored the inode of its file
+        columns = [column[1] for column in connection.execute("PRAGMA table_info(imported)")]
+        if 'inode' not in columns:
+            connection.execute("ALTER TABLE imported ADD COLUMN inode INTEGER")
+        # Number of clears and highest row id per ledger the listeners know of
+        self.seen = {key: self.position(connection, key) for key in ('data', 'contracts')}
+
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.filename, timeout=30, cached_statements=256)
+            connection.execute(f"PRAGMA synchronous={self.synchronous}")
+            self.local.connection = connection
+        return connection
+
+    def close(self):
+        # Only the calling thread's connection, the others close with their thread
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+    def create_ledger(self, key):
+        self.clear(key)
+
+    def compact(self, key=None, archive=True):
+        # Lookups are indexed already, only fold the WAL back into the database
+        self.connection().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return {}
+
+    def position(self, connection, key):
+        table = 'data' if key == 'data' else 'contracts'
+        count, last_id = connection.execute(
+            f"SELECT (SELECT count FROM resets WHERE ledger = ?), (SELECT max(id) FROM {table})",
+            (key,)).fetchone()
+        return count or 0, last_id or 0
+
+    def catch_up(self, connection, key):
+        """
+        Tell the listeners about the clears and rows of other processes since
+        the last write or refresh. Needs write_lock.
+        """
+        count, last_id = self.position(connection, key)
+        seen_count, seen_id = self.seen[key]
+        if count != seen_count:
+            self.seen[key] = count, last_id
+            for listener in self.listeners:
+                listener.ledger_reset(key)
+        elif last_id > seen_id:
+            if key == 'data':
+                select = f"SELECT {self.DATA_COLUMNS} FROM data WHERE id > ? AND id <= ? ORDER BY id"
+            else:
+                select = f"SELECT {self.CONTRACT_COLUMNS} FROM contracts WHERE id > ? AND id <= ? ORDER BY id"
+            self.seen[key] = count, last_id
+            for row in connection.execute(select, (seen_id, last_id)).fetchall():
+                for listener in self.listeners:
+                    listener.row_added(key, list(row))
+
+    def refresh(self, key=None):
+        """
+        Take over the rows other processes wrote to one ledger, or to both
+        when key is None.
+        """
+        connection = self.connection()
+        for key in (key,) if key else ('data', 'contracts'):
+            if self.position(connection, key) != self.seen[key]:
+                with self.write_lock:
+                    self.catch_up(connection, key)
+
+    def clear(self, key):
+        table = 'data' if key == 'data' else 'contracts'
+        with self.write_lock:
+            with self.connection() as connection:
+                # Takes the database write lock, other processes wait
+                connection.execute("BEGIN IMMEDIATE")
+                connection.execute(f"DELETE FROM {table}")
+                connection.execute(
+                    "INSERT INTO resets (ledger, count) VALUES (?, 1) "
+                    "ON CONFLICT (ledger) DO UPDATE SET count = count + 1", (key,))
+                self.seen[key] = self.position(connection, key)
+            for listener in self.listeners:
+                listener.ledger_reset(key)
+
+    def insert(self, key, rows):
+        if key == 'data':
+            insert = f"INSERT INTO data ({self.DATA_COLUMNS}) VALUES (?, ?, ?, ?, ?)"
+        else:
+            insert = f"INSERT INTO contracts ({self.CONTRACT_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)"
+        rows = [[csv_value(value) for value in row] for row in rows]
+        with self.write_lock:
+            with self.connection() as connection:
+                # Takes the database write lock, so the rows of other
+                # processes are handed on first and none slip in between
+                connection.execute("BEGIN IMMEDIATE")
+                self.catch_up(connection, key)
+                connection.executemany(insert, rows)
+                self.seen[key] = self.position(connection, key)
+            for row in rows:
+                for listener in self.listeners:
+                    listener.row_added(key, row)
+        return rows
+
+    def append_data(self, row):
+        return self.insert('data', [row])[0]
+
+    def append_contract(self, row):
+        return self.insert('contracts', [row])[0]
+
+    def append_data_many(self, rows):
+        return self.insert('data', rows)
+
+    def append_contracts_many(self, rows):
+        return self.insert('contracts', rows)
+
+    def find_data(self, company, parameter):
+        """
+        Yield the data rows of a company parameter, newest first.
+        """
+        cursor = self.connection().execute(
+            f"SELECT {self.DATA_COLUMNS} FROM data WHERE account = ? AND parameter = ? "
+            "ORDER BY timestamp DESC, id DESC", (company, parameter))
+        for row in cursor:
+            yield list(row)
+
+    def find_history(self, company, parameter, start=None, end=None, offset=0, limit=None,
+                     newest_first=False):
+        """
+        Yield the data rows of a company parameter with a timestamp between
+        start and end (both inclusive, None for no bound), oldest first.
+        Answered from the (account, parameter, timestamp) index.
+
+        Args:
+            offset: Number of matching rows to skip
+            limit: Maximum number of rows, None for all
+            newest_first: Yield the newest matching row first
+        """
+        order = "DESC" if newest_first else "ASC"
+        # Open bounds are passed as the lowest and highest strings, which
+        # keeps the statement text fixed
+        cursor = self.connection().execute(
+            f"SELECT {self.DATA_COLUMNS} FROM data WHERE account = ? AND parameter = ? "
+            f"AND timestamp >= ? AND timestamp <= ? ORDER BY timestamp {order}, id {order} "
+            "LIMIT ? OFFSET ?",
+            (company, parameter, start if start is not None else '',
+             end if end is not None else '\uffff', limit if limit is not None else -1, offset))
+        for row in cursor:
+            yield list(row)
+
+    def find_contracts(self, company=None, supplier=None, receiver=None):
+        """
+        Yield the contract rows matching all given filters, newest first.
+        """
+        conditions = []
+        parameters = []
+        if supplier:
+            conditions.append("supplier = ?")
+            parameters.append(supplier)
+        if receiver:
+            conditions.append("receiver = ?")
+            parameters.append(receiver)
+        if company:
+            conditions.append("(supplier = ? OR receiver = ?)")
+            parameters += [company, company]
+        where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+        cursor = self.connection().execute(
+            f"SELECT {self.CONTRACT_COLUMNS} FROM contracts {where}ORDER BY id DESC", parameters)
+        for row in cursor:
+            yield list(row)
+
+    def export(self, key, since=None):
+        """
+        All rows of a ledger in the order they were written.
+
+        Args:
+            key: 'data' or 'contracts'
+            since: Checkpoint of an earlier export, only the rows written
+                   after it are returned
+
+        Returns:
+            Tuple of a row iterator and the checkpoint after its last row,
+            the highest row id
+
+        Raises:
+            ValueError: When since is not a checkpoint of this ledger
+        """
+        if since is not None and not since.isdigit():
+            raise ValueError(f"Checkpoint {since} is not part of this ledger")
+        since_id = int(since) if since is not None else 0
+        last_id = self.position(self.connection(), key)[1]
+        if key == 'data':
+            select = f"SELECT {self.DATA_COLUMNS} FROM data WHERE id > ? AND id <= ? ORDER BY id"
+        else:
+            select = f"SELECT {self.CONTRACT_COLUMNS} FROM contracts WHERE id > ? AND id <= ? ORDER BY id"
+
+        def rows():
+            # Runs in the thread that reads the rows, which has its own connection
+            for row in self.connection().execute(select, (since_id, last_id)):
+                yield list(row)
+        return rows(), str(last_id)
+
+    def iter_data(self):
+        for row in self.connection().execute(f"SELECT {self.DATA_COLUMNS} FROM data ORDER BY id"):
+            yield list(row)
+
+    def iter_contracts(self):
+        for row in self.connection().execute(f"SELECT {self.CONTRACT_COLUMNS} FROM contracts ORDER BY id"):
+            yield list(row)
+
+    def import_csv(self, filename, key, batch_size=10000):
+        """
+        Copy the rows of a CSV ledger that were not imported yet, from its
+        archived segments and the ledger file.
+
+        The inode of the file and the byte offset reached are stored with the
+        rows in the same transaction, so the import can be repeated while the
+        CSV ledger keeps serving traffic and each run only copies what was
+        appended since. An archiving compaction renames the file to a segment
+        with the same inode, the next run goes on from there and then reads
+        the newer segments and the new file.
+
+        Returns:
+            Number of rows imported
+
+        Raises:
+            ValueError: When the file of the last import is gone, e.g.
+                        because the ledger was cleared
+        """
+        if key == 'data':
+            insert = f"INSERT INTO data ({self.DATA_COLUMNS}) VALUES (?, ?, ?, ?, ?)"
+            width = 5
+        else:
+            insert = f"INSERT INTO contracts ({self.CONTRACT_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)"
+            width = 6
+        found = self.connection().execute(
+            "SELECT inode, offset FROM imported WHERE filename = ?", (filename,)).fetchone()
+
+        files = list_segments(filename) + [filename]
+        inodes = [os.stat(name).st_ino for name in files]
+        start, offset = 0, None
+        if found:
+            inode, offset = found
+            # Imported before the inode was stored, from the ledger file
+            if inode is None:
+                inode = inodes[-1]
+            if inode not in inodes:
+                raise ValueError(f"{filename} was replaced since the last import, "
+                                 f"import it into a new database")
+            start = inodes.index(inode)
+
+        imported = 0
+        for number in range(start, len(files)):
+            imported += self.import_file(filename, files[number], inodes[number],
+                                         offset if number == start else None, insert, width,
+                                         batch_size)
+        return imported
+
+    def import_file(self, filename, path, inode, offset, insert, width, batch_size):
+        # Rows of one file from offset on, None for the first row
+        connection = self.connection()
+        imported = 0
+        with open(path, mode='rb') as file:
+            header = file.readline()
+            offset = offset if offset is not None else len(header)
+            file.seek(offset)
+            while True:
+                batch = []
+                for line in file:
+                    # Leave a partly written last row for the next run
+                    if not line.endswith(b'\n'):
+                        break
+                    offset += len(line)
+                    row = parse_row(line)
+                    if len(row) >= width:
+                        batch.append(row[:width])
+                    if len(batch) >= batch_size:
+                        break
+                with connection:
+                    connection.executemany(insert, batch)
+                    connection.execute(
+                        "INSERT OR REPLACE INTO imported (filename, offset, inode) VALUES (?, ?, ?)",
+                        (filename, offset, inode))
+                imported += len(batch)
+                if len(batch) < batch_size:
+                    return imported
+
+
+def import_csv_ledger(data_filename, contracts_filename, sqlite_filename):
+    """
+    Import existing ledger_Data.csv / ledger_Contracts.csv files into SQLite.
+
+    Run it once while the CSV ledger is live, then once more after stopping
+    writes; the second run only copies the rows appended in between.
+    """
+    storage = SqliteStorage(sqlite_filename)
+    data_rows = storage.import_csv(data_filename, 'data')
+    contract_rows = storage.import_csv(contracts_filename, 'contracts')
+    print(f"Imported {data_rows} data rows and {contract_rows} contracts into {sqlite_filename}")
+    return storage
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3 or sys.argv[1] not in ('import', 'compact'):
+        print("Usage: python ledger_storage.py [import|compact] [ledger.csv]")
+        sys.exit(1)
+    base_filename = os.path.splitext(sys.argv[2])[0]
+    if sys.argv[1] == 'import':
+        import_csv_ledger(f"{base_filename}_Data.csv", f"{base_filename}_Contracts.csv",
+                          f"{base_filename}.db")
+    else:
+        # Only while the API is stopped, a running API compacts with POST /compact
+        storage = CsvStorage(f"{base_filename}_Data.csv", f"{base_filename}_Contracts.csv")
+        print(f"Rows kept in the snapshots: {storage.compact()}")
+        storage.close()
@@ -0,0 +1,141 @@
+import csv
+import io
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+FSYNC_POLICIES = ('none', 'batch', 'row')
+
+
+def encode_row(row):
+    # Encode a row exactly like csv.writer does on a file opened with newline=''
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(row)
+    return buffer.getvalue().encode()
+
+
+class AppendWriter:
+    """
+    Group-commit appender for a CSV ledger file.
+
+    One background thread owns a single append handle. Rows queued by
+    concurrent callers are written together in one write call, so a burst of
+    requests costs one write (and at most one fsync) instead of an
+    open/write/close per row.
+
+    Args:
+        filename: CSV file to append to
+        flush_interval: Seconds to wait for more rows before writing a batch
+        flush_size: Maximum number of rows per write
+        fsync: 'none' (hand the rows to the OS), 'batch' (fsync every write)
+               or 'row' (fsync after each row)
+        on_write: Called as on_write(row, offset) in file order, before the
+                  callers are released
+        lock: Context manager held while a batch is written, a new
+              threading.Lock by default
+    """
+
+    def __init__(self, filename, flush_interval=0.0, flush_size=1000, fsync='none', on_write=None,
+                 lock=None):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"fsync must be one of {FSYNC_POLICIES}")
+        self.filename = filename
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.fsync = fsync
+        self.on_write = on_write
+        # Held while a batch is written, take it to change the file safely
+        self.lock = lock if lock is not None else threading.Lock()
+
+        self.file = open(filename, mode='ab')
+        self.pending = []
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name=f"AppendWriter({filename})", daemon=True)
+        self.thread.start()
+
+    def append(self, row):
+        """
+        Queue a row and return a Future with its byte offset, which resolves
+        once the row was written according to the fsync policy.
+        """
+        return self.append_many([row])[0]
+
+    def append_many(self, rows):
+        # Rows queued together are written in the same batch when they fit
+        futures = []
+        with self.condition:
+            if self.closed:
+                raise ValueError("AppendWriter is closed")
+            for row in rows:
+                future = Future()
+                self.pending.append((row, encode_row(row), future))
+                futures.append(future)
+            self.condition.notify()
+        return futures
+
+    def write(self, row):
+        # Append a row and wait until it is durable
+        return self.append(row).result()
+
+    def reopen(self):
+        # Switch to a new file under the same name, hold self.lock to call it
+        self.file.close()
+        self.file = open(self.filename, mode='ab')
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+        self.file.close()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                # Give concurrent requests a moment to join the batch
+                deadline = time.monotonic() + self.flush_interval
+                while len(self.pending) < self.flush_size and not self.closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                batch = self.pending[:self.flush_size]
+                del self.pending[:self.flush_size]
+
+            try:
+                with self.lock:
+                    self.write_batch(batch)
+            except Exception as error:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+
+    def write_batch(self, batch):
+        offset = self.file.seek(0, os.SEEK_END)
+        if self.fsync == 'row':
+            for row, line, future in batch:
+                self.file.write(line)
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.written(row, offset, future)
+                offset += len(line)
+            return
+
+        self.file.write(b''.join(line for _, line, _ in batch))
+        self.file.flush()
+        if self.fsync == 'batch':
+            os.fsync(self.file.fileno())
+        for row, line, future in batch:
+            self.written(row, offset, future)
+            offset += len(line)
+
+    def written(self, row, offset, future):
+        if self.on_write:
+            self.on_write(row, offset)
+        future.set_result(offset)
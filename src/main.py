@@ -1,82 +1,210 @@
-import csv
 import datetime
+import hashlib
+import math
 import os
-from flask import Flask, request, jsonify
+import queue
+import threading
+from flask import Flask, Response, request, jsonify, make_response
 import json
+import logging
+from urllib.parse import quote
+from aggregates import Allocations, OutputAggregates
+from bulk_ingest import CONTRACT_FIELDS, DATA_FIELDS, check_number, check_text, iter_records, validate_record
+from labels import LabelRegistry, format_labels
+from ledger_storage import CsvStorage, SqliteStorage
+from ledger_writer import FSYNC_POLICIES, encode_row
+import montecarlo
+from propagation import SupplyGraph
+from result_cache import VersionedCache
 
 app = Flask(__name__)
+logger = logging.getLogger(__name__)
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Columns of the exported rows, the same names the add endpoints take
+EXPORT_FIELDS = {'data': ('timestamp',) + DATA_FIELDS, 'contracts': ('timestamp',) + CONTRACT_FIELDS}
+EXPORT_FORMATS = ('csv', 'ndjson')
+
+
+def parse_timestamp(text, end_of_day=False):
+    """
+    Read an ISO date or date and time into the ledger's timestamp format.
+
+    Args:
+        text: e.g. '2025-03-10' or '2025-03-10T14:00'
+        end_of_day: Let a plain date stand for its last second instead of
+                    its first
+
+    Raises:
+        ValueError: When text is not an ISO date
+    """
+    timestamp = datetime.datetime.fromisoformat(text)
+    if end_of_day and len(text) <= 10:
+        timestamp = timestamp.replace(hour=23, minute=59, second=59)
+    return timestamp.strftime(TIMESTAMP_FORMAT)
+
+
+def same_output(result, expected):
+    # calculate_output results, equal up to rounding of the sums
+    if isinstance(result, dict):
+        return (isinstance(expected, dict) and result.keys() == expected.keys()
+                and all(same_output(result[key], expected[key]) for key in result))
+    if isinstance(result, (list, Allocations)):
+        return (isinstance(expected, (list, Allocations)) and len(result) == len(expected)
+                and all(same_output(a, b) for a, b in zip(result, expected)))
+    if isinstance(result, (int, float)) and isinstance(expected, (int, float)):
+        return math.isclose(result, expected, rel_tol=1e-9, abs_tol=1e-6)
+    return result == expected
 
 
 class Ledger:
-    def __init__(self, filename='ledger.csv'):
+    def __init__(self, filename='ledger.csv', storage='csv', verify_aggregates=False,
+                 flush_interval=0.0, flush_size=1000, fsync='none'):
+        """
+        Args:
+            filename: Base name of the ledger files
+            storage: 'csv' (default), 'sqlite' or a storage backend instance
+                     from ledger_storage
+            verify_aggregates: Check every calculate_output against a full
+                               recompute
+            flush_interval: Seconds the CSV writer waits for more rows
+                            before writing a batch
+            flush_size: Maximum number of rows per CSV write
+            fsync: 'none', 'batch' or 'row', see AppendWriter. For SQLite
+                   anything but 'none' commits with synchronous=FULL.
+        """
         # Extract the base name from the input filename (without extension)
         base_filename = os.path.splitext(filename)[0]
 
         # Create new filenames based on the base name
         self.data_filename = f"{base_filename}_Data.csv"
         self.contracts_filename = f"{base_filename}_Contracts.csv"
-        # Create the CSV file with header if it doesn't exist
-        try:
-            with open(self.data_filename, mode='r') as file:
-                pass
-                #self.clear_csv(self.data_filename)  # file exists
-        except FileNotFoundError:
-            self.create_ledger('data')
-        # Create the CSV file with header if it doesn't exist
-        try:
-            with open(self.contracts_filename, mode='r') as file:
-                pass
-                #self.clear_csv(self.contracts_filename)  # file exists
-        except FileNotFoundError:
-            self.create_ledger('contracts')
-
-    def clear_csv(self,filename):
-        # write mode ('w') to clear its contents
-        with open(filename, mode='r', newline='') as file:
-            # Read the first line (header)
-            header = file.readline()
-
-        # Open the file in write mode to clear its content
-        with open(filename, mode='w', newline='') as file:
-            # Write the header back to the file
-            file.write(header)
-
-    def create_ledger(self, key ):
-        match key:
-            case "data":
-                filename = self.data_filename
-                header = ['timestamp', 'labels', 'account', 'parameter', 'amount']
-            case "contracts":
-                filename = self.contracts_filename
-                header = ['timestamp', 'labels', 'Supplier', 'Receiver', 'amount', 'Priority']
-        with open(filename, mode='w', newline='') as file:
-            writer = csv.writer(file)
-            writer.writerow(header)
+
+        match storage:
+            case "csv":
+                self.storage = CsvStorage(self.data_filename, self.contracts_filename,
+                                          flush_interval, flush_size, fsync)
+            case "sqlite":
+                if fsync not in FSYNC_POLICIES:
+                    raise ValueError(f"fsync must be one of {FSYNC_POLICIES}")
+                self.storage = SqliteStorage(f"{base_filename}.db",
+                                             synchronous='NORMAL' if fsync == 'none' else 'FULL')
+            case _:
+                self.storage = storage
+
+        # Parsed label sets, used for every permission check
+        self.labels = LabelRegistry()
+
+        # Bumped on every write, cached results are only valid for one version
+        self.version = 0
+        self.version_lock = threading.Lock()
+        self.modified = datetime.datetime.now(datetime.timezone.utc)
+        self.result_cache = VersionedCache(lambda: self.aggregates.result())
+
+        # State of calculate_output, loaded once and then updated on append
+        self.verify_aggregates = verify_aggregates
+        self.aggregates = OutputAggregates()
+        self.supply_graph = SupplyGraph()
+        self.storage.listeners.append(self)
+        self.ledger_reset('data')
+        self.ledger_reset('contracts')
+
+        # Latest recommendations as (version, {receiver: amount}), plus the
+        # last value saved to the ledger for each receiver
+        self.recommendations = None
+        self.saved_recommendations = {}
+        self.recommendation_lock = threading.Lock()
+        self.recommendation_queue = queue.Queue()
+        threading.Thread(target=self.write_recommendations, daemon=True).start()
+
+    def clear_ledger(self, key):
+        # Remove all rows of the 'data' or 'contracts' ledger
+        self.storage.clear(key)
+
+    def compact(self, archive=True):
+        """
+        Snapshot the rows of both ledgers that queries can still return, so
+        that startup and scans only replay the rows written after it. See
+        CsvStorage.compact.
+        """
+        return self.storage.compact(archive=archive)
 
     def add_company_data(self, labels, account, parameter, amount):
+            # A row that cannot be read back line by line or as a number is
+            # never written
+            for field, text in (('labels', labels), ('account', account), ('parameter', parameter)):
+                check_text(text, field)
+            check_number(amount, 'amount')
             timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            labels = set(labels)
-            with open(self.data_filename, mode='a', newline='') as file:
-                writer = csv.writer(file)
-                writer.writerow([timestamp, labels, account, parameter, amount])
+            labels = format_labels(labels)
+            self.storage.append_data([timestamp, labels, account, parameter, amount])
+
+    def add_company_data_many(self, records):
+        """
+        Add many data rows in one batched write.
+
+        Args:
+            records: Lists of [labels, account, parameter, amount]
+        """
+        timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        rows = [[timestamp, format_labels(labels), account, parameter, amount]
+                for labels, account, parameter, amount in records]
+        self.storage.append_data_many(rows)
 
     def get_company_data(self, account= None, company = None, search_parameter=None):
         data = "Not found"
-        with open(self.data_filename, mode='r') as file:
-            reader = csv.reader(file)
-            next(reader)  # Skip header row
-            reader = list(csv.reader(file))
-            for row in reversed(reader):
-                timestamp, labels, comp, parameter, amount = row
-                amount = float(amount)  # Convert amount to a float
-                if parameter == search_parameter and comp == company:
-                    if account and (account in labels):
-                            data = row
-                            break
-                    else:
-                        data = "No Permission"
+        # Rows come newest first, older ones are only read without permission
+        for row in self.storage.find_data(company, search_parameter):
+            if account and self.labels.allows(row[1], account):
+                data = row
+                break
+            else:
+                data = "No Permission"
         return data
     
+    def get_company_data_as_of(self, account=None, company=None, search_parameter=None, as_of=None):
+        """
+        Value of a company parameter at a moment in the past: the newest row
+        written at or before as_of that the account may read.
+
+        Args:
+            as_of: Timestamp in the ledger format
+        """
+        data = "Not found"
+        for row in self.storage.find_history(company, search_parameter, end=as_of, newest_first=True):
+            if account and self.labels.allows(row[1], account):
+                data = row
+                break
+            else:
+                data = "No Permission"
+        return data
+
+    def get_company_history(self, account=None, company=None, search_parameter=None,
+                            start=None, end=None, cursor=0, limit=1000):
+        """
+        Rows of a company parameter written between start and end, oldest first.
+
+        Rows the account may not read are left out. The cursor counts rows of
+        the time range, so a page can hold fewer than limit rows.
+
+        Args:
+            start: First timestamp in the ledger format, None for no bound
+            end: Last timestamp in the ledger format, None for no bound
+            cursor: Position in the time range to start from
+            limit: Maximum number of rows to look at
+
+        Returns:
+            Tuple of the readable rows and the cursor of the next page, None
+            after the last page
+        """
+        # One extra row tells whether there is a next page
+        rows = list(self.storage.find_history(company, search_parameter, start, end,
+                                              offset=cursor, limit=limit + 1))
+        next_cursor = cursor + limit if len(rows) > limit else None
+        data = [row for row in rows[:limit] if account and self.labels.allows(row[1], account)]
+        return data, next_cursor
+
     def add_company_contract(self, labels, supplier, receiver, parameter, value):
         """
         Add a contract between a supplier and receiver to the contracts ledger
@@ -86,15 +214,32 @@ class Ledger:
             receiver: The receiver company name
             amount: Contract amount
             priority: Priority level of the contract
+
+        Raises:
+            ValueError: When value is not a number or a text field holds a
+                line break
         """
+        for field, text in (('labels', labels), ('supplier', supplier), ('receiver', receiver),
+                            ('parameter', parameter)):
+            check_text(text, field)
+        check_number(value, 'value')
         timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
         # Create labels including both supplier and receiver
         #labels = f"{supplier},{receiver}"
 
-        with open(self.contracts_filename, mode='a', newline='') as file:
-            writer = csv.writer(file)
-            writer.writerow([timestamp, labels, supplier, receiver, parameter, value])
+        self.storage.append_contract([timestamp, labels, supplier, receiver, parameter, value])
+
+    def add_company_contracts_many(self, records):
+        """
+        Add many contracts in one batched write.
+
+        Args:
+            records: Lists of [labels, supplier, receiver, parameter, value]
+        """
+        timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        rows = [[timestamp] + list(record) for record in records]
+        self.storage.append_contracts_many(rows)
 
     def get_company_contract(self, account=None, company=None, supplier=None, receiver=None):
         """
@@ -112,127 +257,313 @@ class Ledger:
         """
         data = "Not found"
 
-        with open(self.contracts_filename, mode='r') as file:
-            reader = csv.reader(file)
-            next(reader)  # Skip header row
-            reader = list(csv.reader(file))
-
-            for row in reversed(reader):
-                if len(row) >= 6:  # Ensure we have all columns
-                    timestamp, labels, sup, rec, amount, prio = row
-
-                    # Check if row matches search criteria
-                    matches_company = not company or (company == sup or company == rec)
-                    matches_supplier = not supplier or supplier == sup
-                    matches_receiver = not receiver or receiver == rec
-                    #matches_priority = not priority or str(priority) == prio
-
-                    # Only return data if the requesting account has permission
-                    if matches_company and matches_supplier and matches_receiver:
-                        if account and (account in labels):
-                            # Convert amount to float for consistency
-                            data = row
-                            break
-                        else:
-                            data = "No Permission"
+        for row in self.storage.find_contracts(company, supplier, receiver):
+            # Only return data if the requesting account has permission
+            if account and self.labels.allows(row[1], account):
+                data = row
+                break
+            else:
+                data = "No Permission"
 
         return data
 
-    def calculate_output(self):
-        # Get company A's available materials
-        company_a_data = {}
-        company_b_data = {}
-        company_c_data = {}
-
-        # Read all data from the data file
-        with open(self.data_filename, mode='r') as file:
-            reader = csv.reader(file)
-            next(reader)  # Skip header row
-            for row in reader:
-                if len(row) >= 5:
-                    _, labels_str, account, parameter, amount = row
-                    # Convert string representation of set to actual set
-                    labels = eval(labels_str) if labels_str else set()
-
-                    if 'A' in labels and parameter == 'materials':
-                        company_a_data['materials'] = float(amount)
-                    elif 'B' in labels and parameter == 'storage':
-                        company_b_data['storage'] = float(amount)
-                    elif 'C' in labels and parameter == 'storage':
-                        company_c_data['storage'] = float(amount)
+    def batch_query(self, account, lookups):
+        """
+        Answer many get_company_data and get_company_contract lookups of one
+        account. Each lookup is one index probe and identical lookups are
+        answered once.
 
-        # Get contract data
-        contracts = []
-        with open(self.contracts_filename, mode='r') as file:
-            reader = csv.reader(file)
-            next(reader)  # Skip header row
-            for row in reader:
-                if len(row) >= 6:
-                    _, labels_str, supplier, receiver, parameter, value = row
-                    if supplier == 'A' and parameter == 'vaccines':
-                        contracts.append({
-                            'supplier': supplier,
-                            'receiver': receiver,
-                            'requested': float(value)
-                        })
-        # Calculate proportional distribution
-        available_materials = company_a_data.get('materials', 0)
-        total_storage = company_b_data.get('storage', 0) + company_c_data.get('storage', 0)
-        total_requested = sum(c['requested'] for c in contracts)
+        Args:
+            account: Account requesting the data (for permission checking)
+            lookups: Dictionaries with 'ledger' ('data', the default, or
+                     'contracts') and the filters of the single lookup:
+                     'company' and 'search' for data, 'company', 'supplier'
+                     and 'receiver' for contracts
 
+        Returns:
+            One dictionary per lookup, in request order, with its 'index',
+            'status' ('ok', 'no_permission', 'not_found' or 'error') and
+            the row as 'data' or the reason as 'error'
+        """
+        answers = {}
         results = []
+        for index, lookup in enumerate(lookups):
+            if not isinstance(lookup, dict):
+                results.append({"index": index, "status": "error", "error": "lookup must be an object"})
+                continue
+            ledger_key = lookup.get('ledger', 'data')
+            if ledger_key == 'data':
+                key = ('data', lookup.get('company'), lookup.get('search'))
+                if not key[1] or not key[2]:
+                    results.append({"index": index, "status": "error",
+                                    "error": "data lookups need company and search"})
+                    continue
+            elif ledger_key == 'contracts':
+                key = ('contracts', lookup.get('company'), lookup.get('supplier'), lookup.get('receiver'))
+            else:
+                results.append({"index": index, "status": "error",
+                                "error": "ledger must be 'data' or 'contracts'"})
+                continue
+
+            if key not in answers:
+                if key[0] == 'data':
+                    answers[key] = self.get_company_data(account, key[1], key[2])
+                else:
+                    answers[key] = self.get_company_contract(account, *key[1:])
+            answer = answers[key]
+            if answer == "No Permission":
+                results.append({"index": index, "status": "no_permission"})
+            elif answer == "Not found":
+                results.append({"index": index, "status": "not_found"})
+            else:
+                results.append({"index": index, "status": "ok", "data": answer})
+        return results
+
+    def export(self, account, key, format='csv', since=None, chunk_size=64 * 1024):
+        """
+        Stream the rows of a ledger the account may read, oldest first.
 
-        if total_storage > 0 and total_requested > 0:
-            # Calculate distribution proportionally to storage
-            for contract in contracts:
-                receiver = contract['receiver']
-                requested = contract['requested']
+        Args:
+            account: Account requesting the export (for permission checking)
+            key: 'data' or 'contracts'
+            format: 'csv' (with a header line) or 'ndjson'
+            since: Checkpoint returned by an earlier export, to only get the
+                   rows written after it
+            chunk_size: Approximate number of bytes per chunk
+
+        Returns:
+            Tuple of a generator of byte chunks and the checkpoint to pass
+            as since next time
 
-                if receiver == 'B':
-                    storage_capacity = company_b_data.get('storage', 0)
-                elif receiver == 'C':
-                    storage_capacity = company_c_data.get('storage', 0)
+        Raises:
+            ValueError: For an unknown ledger or format or a bad checkpoint
+        """
+        if key not in EXPORT_FIELDS:
+            raise ValueError("ledger must be 'data' or 'contracts'")
+        if format not in EXPORT_FORMATS:
+            raise ValueError(f"format must be one of {EXPORT_FORMATS}")
+        rows, checkpoint = self.storage.export(key, since)
+        return self.export_chunks(rows, EXPORT_FIELDS[key], account, format, chunk_size), checkpoint
+
+    def export_chunks(self, rows, fields, account, format, chunk_size):
+        # Only one chunk is kept in memory at a time
+        chunk = [encode_row(fields)] if format == 'csv' else []
+        size = 0
+        for row in rows:
+            if len(row) < len(fields) or not (account and self.labels.allows(row[1], account)):
+                continue
+            if format == 'csv':
+                line = encode_row(row[:len(fields)])
+            else:
+                line = (json.dumps(dict(zip(fields, row))) + '\n').encode()
+            chunk.append(line)
+            size += len(line)
+            if size >= chunk_size:
+                yield b''.join(chunk)
+                chunk = []
+                size = 0
+        if chunk:
+            yield b''.join(chunk)
+
+    def row_added(self, key, row):
+        # Storage listener, called for every new row in ledger order
+        self.aggregates.add_row(key, row)
+        self.supply_graph.add_row(key, row)
+        self.bump_version()
+
+    def ledger_reset(self, key):
+        # Storage listener, the rows of a ledger were cleared or compacted
+        rows = list(self.storage.iter_data() if key == 'data' else self.storage.iter_contracts())
+        self.aggregates.rebuild(key, rows)
+        self.supply_graph.rebuild(key, rows)
+        if key == 'data':
+            self.saved_recommendations = {}
+        self.bump_version()
+
+    def bump_version(self):
+        with self.version_lock:
+            self.version += 1
+            self.modified = datetime.datetime.now(datetime.timezone.utc)
+
+    def calculate_output(self, verify=False):
+        """
+        Calculate the proportional vaccine distribution from the running
+        aggregates, without reading the ledger.
+
+        Args:
+            verify: Also recompute from the full ledger and raise a
+                    RuntimeError when the results differ. Always on when
+                    the ledger was created with verify_aggregates=True.
+        """
+        # Rows written by other processes sharing the ledger files
+        self.storage.refresh()
+        if verify or self.verify_aggregates:
+            result = self.aggregates.result()
+            expected = self.calculate_output_full()
+            if not same_output(result, expected):
+                raise RuntimeError(f"Aggregates out of sync: {result} != {expected}")
+            return result
+        # Shared by every reader until the next write, do not modify it
+        return self.result_cache.get(self.version)
+
+    def calculate_output_full(self):
+        """
+        Reference for calculate_output: scans every row ever written to both
+        ledgers, archived segments included, and computes the allocation row
+        by row in plain Python. It shares no code with OutputAggregates,
+        allocation.allocate or the compaction snapshots.
+        """
+        data_rows, _ = self.storage.export('data')
+        contract_rows, _ = self.storage.export('contracts')
+
+        materials = {}
+        storage = {}
+        for row in data_rows:
+            if len(row) >= 5:
+                _, labels_str, account, parameter, amount = row[:5]
+                if parameter not in ('materials', 'storage'):
+                    continue
+                try:
+                    amount = float(amount)
+                except ValueError:
+                    # Skipped by the aggregates as well
+                    continue
+                if parameter == 'materials':
+                    materials[account] = amount
                 else:
-                    storage_capacity = 0
+                    storage[account] = amount
+
+        # Get contract data
+        contracts = []
+        for row in contract_rows:
+            if len(row) >= 6:
+                _, labels_str, supplier, receiver, parameter, value = row[:6]
+                if parameter != 'vaccines':
+                    continue
+                try:
+                    value = float(value)
+                except ValueError:
+                    continue
+                contracts.append({
+                    'supplier': supplier,
+                    'receiver': receiver,
+                    'requested': value
+                })
 
+        # Every supplier splits its own materials over its own contracts
+        suppliers = {}
+        for contract in contracts:
+            totals = suppliers.setdefault(contract['supplier'], {'receivers': set(), 'total_requested': 0})
+            totals['receivers'].add(contract['receiver'])
+            totals['total_requested'] += contract['requested']
+        for supplier, totals in suppliers.items():
+            totals['available_materials'] = materials.get(supplier, 0.0)
+            totals['total_storage'] = sum(storage.get(receiver, 0.0) for receiver in totals.pop('receivers'))
+
+        results = []
+        for contract in contracts:
+            totals = suppliers[contract['supplier']]
+            if totals['total_storage'] > 0 and totals['total_requested'] > 0:
+                storage_capacity = storage.get(contract['receiver'], 0.0)
                 # Calculate proportion based on storage capacity
-                proportion = storage_capacity / total_storage
-                fair_amount = min(available_materials * proportion, requested)
+                proportion = storage_capacity / totals['total_storage']
+                fair_amount = min(totals['available_materials'] * proportion, contract['requested'])
 
                 results.append({
-                    'receiver': receiver,
-                    'requested': requested,
+                    'supplier': contract['supplier'],
+                    'receiver': contract['receiver'],
+                    'requested': contract['requested'],
                     'recommended vaccines to order from others': storage_capacity-round(fair_amount, 0),
                     'capacity': storage_capacity,
                     'fill_percentage': round((fair_amount / storage_capacity * 100 if storage_capacity > 0 else 0), 2)
                 })
         return {
-            'available_materials': available_materials,
-            'total_storage': total_storage,
-            'total_requested': total_requested,
+            'available_materials': sum(materials.get(supplier, 0.0) for supplier in suppliers),
+            'total_storage': sum(storage.get(receiver, 0.0)
+                                 for receiver in {contract['receiver'] for contract in contracts}),
+            'total_requested': sum(contract['requested'] for contract in contracts),
+            'suppliers': {supplier: {key: float(value) for key, value in totals.items()}
+                          for supplier, totals in suppliers.items()},
             'allocations': results
         }
-    
+
+    def get_shortfall(self, acc):
+        """
+        Vaccines the account can expect from its suppliers once shortfalls
+        further up the supply chain are taken into account.
+        """
+        self.storage.refresh()
+        shortfall = self.supply_graph.shortfall(acc)
+        return shortfall if shortfall is not None else "Not found"
+
+    def simulate_disruptions(self, **options):
+        """
+        Percentile recommendations per receiver under sampled production
+        disruptions, see montecarlo.simulate for the options. Runs on a copy
+        of the current ledger state and changes nothing.
+        """
+        return montecarlo.simulate(self.aggregates.arrays(), **options)
+
     def get_result(self, acc):
+        # Served from memory, only recomputed after the ledger changed
+        return self.get_recommendations().get(acc, "Not found")
+
+    def get_recommendations(self):
+        """
+        Recommended vaccines to order per receiver for the current ledger version.
+
+        A recommendation is saved to the data ledger only when it differs from
+        the last saved one, by a background thread off the request path.
+        """
+        self.storage.refresh()
+        version = self.version
+        cached = self.recommendations
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
         # Calculate fair distribution
         result = self.calculate_output()
-        output = "Not found"
-        # Save only the recommended vaccines to order for each company
-        print(result)
-        for allocation in result['allocations']:
-            print(allocation)
-            receiver = allocation['receiver']
-            recommended_vaccines = round(allocation['recommended vaccines to order'])
-            if allocation['receiver'] == acc:
-                output = round(allocation['recommended vaccines to order'])
-            # Save the recommended vaccines to order for each company
-            self.add_company_data([receiver], receiver, 'recommended_vaccines_to_order', recommended_vaccines)
-
-        return output
+        recommendations = {receiver: round(recommended) for receiver, recommended in
+                           result['allocations'].recommended_by_receiver().items()}
+        self.recommendations = (version, recommendations)
+
+        # Save only the recommended vaccines to order that changed
+        with self.recommendation_lock:
+            for receiver, recommended_vaccines in recommendations.items():
+                if self.saved_recommendation(receiver) != recommended_vaccines:
+                    self.saved_recommendations[receiver] = recommended_vaccines
+                    self.recommendation_queue.put((receiver, recommended_vaccines))
+        return recommendations
+
+    def saved_recommendation(self, receiver):
+        if receiver not in self.saved_recommendations:
+            row = next(self.storage.find_data(receiver, 'recommended_vaccines_to_order'), None)
+            self.saved_recommendations[receiver] = float(row[4]) if row else None
+        return self.saved_recommendations[receiver]
+
+    def write_recommendations(self):
+        # Write-behind thread for get_recommendations
+        while True:
+            receiver, recommended_vaccines = self.recommendation_queue.get()
+            try:
+                self.add_company_data([receiver], receiver, 'recommended_vaccines_to_order',
+                                      recommended_vaccines)
+            except Exception:
+                logger.exception("Could not save the recommendation %s for %s",
+                                 recommended_vaccines, receiver)
+                # Forget it was saved, the next read computes and queues it again
+                with self.recommendation_lock:
+                    if self.saved_recommendations.get(receiver) == recommended_vaccines:
+                        del self.saved_recommendations[receiver]
+                    self.recommendations = None
     
 
 
-ledger = Ledger()
+ledger = Ledger(storage=os.environ.get('LEDGER_STORAGE', 'csv'),
+                verify_aggregates=os.environ.get('LEDGER_VERIFY_AGGREGATES') == '1',
+                flush_interval=float(os.environ.get('LEDGER_FLUSH_INTERVAL', 0.0)),
+                flush_size=int(os.environ.get('LEDGER_FLUSH_SIZE', 1000)),
+                fsync=os.environ.get('LEDGER_FSYNC', 'none'))
 
 #base 
 @app.route('/')
@@ -247,7 +578,10 @@ def add_company_data():
     parameter = data['parameter']
     amount = data['amount']
 
-    ledger.add_company_data(labels, account, parameter, amount)
+    try:
+        ledger.add_company_data(labels, account, parameter, amount)
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
     return jsonify({"message": "Data added successfully"}), 200
 
 @app.route('/add_company_contracts', methods=['POST'])
@@ -259,9 +593,53 @@ def add_company_contracts():
     parameter = data['parameter']
     value = data['value']
 
-    ledger.add_company_contract(labels, supplier, receiver, parameter, value)
+    try:
+        ledger.add_company_contract(labels, supplier, receiver, parameter, value)
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
     return jsonify({"message": "Data added successfully"}), 200
 
+def bulk_add(fields, add_many):
+    # Parse and validate the body record by record, then store the valid
+    # ones in a single batched write
+    records = []
+    statuses = []
+    for index, (record, error) in enumerate(iter_records(request.stream)):
+        if error is None:
+            try:
+                records.append(validate_record(record, fields))
+            except ValueError as invalid:
+                error = str(invalid)
+        if error is None:
+            statuses.append({"index": index, "status": "ok"})
+        else:
+            statuses.append({"index": index, "status": "error", "error": error})
+
+    if records:
+        add_many(records)
+    return jsonify({
+        "accepted": len(records),
+        "rejected": len(statuses) - len(records),
+        "rows": statuses
+    }), 200
+
+@app.route('/add_company_data_bulk', methods=['POST'])
+def add_company_data_bulk():
+    # Body is a JSON array or NDJSON of /add_company_data records
+    return bulk_add(DATA_FIELDS, ledger.add_company_data_many)
+
+@app.route('/add_company_contracts_bulk', methods=['POST'])
+def add_company_contracts_bulk():
+    # Body is a JSON array or NDJSON of /add_company_contracts records
+    return bulk_add(CONTRACT_FIELDS, ledger.add_company_contracts_many)
+
+@app.route('/compact', methods=['POST'])
+def compact():
+    # Archive the ledger history and keep only a snapshot plus the new rows
+    archive = request.args.get('archive', 'true') != 'false'
+    result = ledger.compact(archive)
+    return jsonify({"message": "Ledger compacted", "snapshot_rows": result}), 200
+
 @app.route('/get_company_data', methods=['GET'])
 def get_company_data():
     account = request.args.get('account')
@@ -273,6 +651,63 @@ def get_company_data():
     return jsonify({"data": result}), 200
 
 
+@app.route('/batch_query', methods=['POST'])
+def batch_query():
+    # {"account": ..., "lookups": [{"ledger": "data", "company": ..., "search": ...},
+    #                              {"ledger": "contracts", "supplier": ..., ...}]}
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('lookups'), list):
+        return jsonify({"error": "Body must be an object with an account and a list of lookups"}), 400
+    if len(data['lookups']) > 1000:
+        return jsonify({"error": "At most 1000 lookups per request"}), 400
+
+    results = ledger.batch_query(data.get('account'), data['lookups'])
+    return jsonify({"results": results}), 200
+
+@app.route('/export', methods=['GET'])
+def export():
+    # ?account=&ledger=data|contracts&format=csv|ndjson&since=<checkpoint>
+    # The X-Ledger-Checkpoint header of the response is the since of the next sync
+    account = request.args.get('account')
+    key = request.args.get('ledger', 'data')
+    format = request.args.get('format', 'csv')
+    try:
+        chunks, checkpoint = ledger.export(account, key, format, request.args.get('since'))
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
+    mimetype = 'text/csv' if format == 'csv' else 'application/x-ndjson'
+    return Response(chunks, mimetype=mimetype, headers={"X-Ledger-Checkpoint": checkpoint}), 200
+
+@app.route('/get_company_history', methods=['GET'])
+def get_company_history():
+    # ?start=&end= for a time range, paginated with ?cursor=&limit=,
+    # or ?as_of= for the value at one moment
+    account = request.args.get('account')
+    company = request.args.get('company')
+    search = request.args.get('search')
+    try:
+        if request.args.get('as_of'):
+            as_of = parse_timestamp(request.args['as_of'], end_of_day=True)
+            result = ledger.get_company_data_as_of(account, company, search, as_of)
+            return jsonify({"data": result}), 200
+        start = parse_timestamp(request.args['start']) if request.args.get('start') else None
+        end = parse_timestamp(request.args['end'], end_of_day=True) if request.args.get('end') else None
+        cursor = int(request.args.get('cursor', 0))
+        limit = int(request.args.get('limit', 1000))
+        if cursor < 0 or not 0 < limit <= 10000:
+            raise ValueError("cursor must not be negative and limit must be between 1 and 10000")
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
+    rows, next_cursor = ledger.get_company_history(account, company, search, start, end, cursor, limit)
+
+    def generate():
+        # Written row by row so a large page is never one big string
+        yield '{"data": ['
+        for index, row in enumerate(rows):
+            yield (', ' if index else '') + json.dumps(row)
+        yield '], "next_cursor": ' + json.dumps(next_cursor) + '}'
+    return Response(generate(), mimetype='application/json'), 200
+
 @app.route('/get_company_contract', methods=['GET'])
 def get_company_contracts():
     account = request.args.get('account')
@@ -290,11 +725,28 @@ def get_result():
     return jsonify({"recommended vaccines": result}), 200
 
 
+@app.route('/get_shortfall', methods=['GET'])
+def get_shortfall():
+    # Only the account's own inbound numbers, never its partners' data
+    account = request.args.get('account')
+    result = ledger.get_shortfall(account)
+    return jsonify({"shortfall": result}), 200
+
+
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    # Hit/miss counts of the calculate_output cache
+    return jsonify(ledger.result_cache.stats()), 200
+
+
 @app.route('/simulate_distribution', methods=['GET'])
 def simulate_distribution():
+    if request.args.get('mode') == 'monte_carlo':
+        return simulate_monte_carlo()
+
     # Clear existing data
-    ledger.clear_csv(ledger.data_filename)
-    ledger.clear_csv(ledger.contracts_filename)
+    ledger.clear_ledger('data')
+    ledger.clear_ledger('contracts')
 
     # Add company data
     ledger.add_company_data(['A'], 'A', 'materials', 300)  # Company A has materials for 300 vaccines
@@ -317,6 +769,20 @@ def simulate_distribution():
 
     return jsonify(result), 200
 
+def simulate_monte_carlo():
+    # Risk estimates against the current ledger, nothing is written
+    options = {}
+    try:
+        for name, convert in (('scenarios', int), ('seed', int), ('time_budget', float),
+                              ('batch_size', int), ('cut_probability', float), ('max_cut', float),
+                              ('loss_probability', float), ('max_loss', float)):
+            if request.args.get(name) is not None:
+                options[name] = convert(request.args.get(name))
+        result = ledger.simulate_disruptions(**options)
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
+    return jsonify(result), 200
+
 
 @app.route('/visualize', methods=['GET'])
 def visualize():
@@ -325,14 +791,91 @@ def visualize():
     if not company:
         return "Please specify a company parameter (A, B, or C)", 400
 
-    # Calculate distribution data
+    # Rendered once per ledger version, browsers revalidate with the ETag
+    page = cached_visualization(company)
+    return conditional_response(page['html'], page['html_etag'], page['modified'], 'text/html')
+
+@app.route('/visualize_data', methods=['GET'])
+def visualize_data():
+    # The numbers of the /visualize page, polled by the page to update its charts
+    company = request.args.get('company')
+    if not company:
+        return jsonify({"error": "Please specify a company parameter (A, B, or C)"}), 400
+
+    page = cached_visualization(company)
+    return conditional_response(page['data'], page['data_etag'], page['modified'], 'application/json')
+
+# Rendered /visualize pages per company, each valid for one ledger version
+visualization_caches = {}
+visualization_lock = threading.Lock()
+
+def cached_visualization(company):
+    """
+    The /visualize page and data of a company for the current ledger
+    version, rendered by the first request after a change.
+    """
+    ledger.storage.refresh()
+    with visualization_lock:
+        cache = visualization_caches.get(company)
+        if cache is None:
+            # The company comes from the query string, keep the cache bounded
+            if len(visualization_caches) >= 1024:
+                visualization_caches.clear()
+            cache = visualization_caches[company] = VersionedCache(lambda: render_page(company))
+    return cache.get(ledger.version)
+
+def render_page(company):
+    modified = ledger.modified
     result = ledger.calculate_output()
+    html = render_visualization(company, result).encode()
+    data = json.dumps(visualization_data(company, result)).encode()
+    # Content hashes, so every worker process gives the same page the same ETag
+    return {
+        'html': html,
+        'html_etag': hashlib.sha1(html).hexdigest(),
+        'data': data,
+        'data_etag': hashlib.sha1(data).hexdigest(),
+        'modified': modified.replace(microsecond=0)
+    }
+
+def conditional_response(body, etag, modified, mimetype):
+    # 304 Not Modified when the client's ETag or date is still current
+    response = make_response(body)
+    response.mimetype = mimetype
+    response.set_etag(etag)
+    response.last_modified = modified
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+def visualization_data(company, result):
+    """
+    What the /visualize page of a company shows: for a supplier its own
+    totals and the allocations of its contracts, for the others their own
+    allocation (or None).
+    """
+    supplier = result['suppliers'].get(company)
+    if supplier is not None:
+        return {
+            'company': company,
+            'available_materials': supplier['available_materials'],
+            'total_storage': supplier['total_storage'],
+            'total_requested': supplier['total_requested'],
+            'allocations': result['allocations'].where('supplier', company)
+        }
+    return {
+        'company': company,
+        'allocation': next(iter(result['allocations'].where('receiver', company)), None)
+    }
 
-    # Filter allocations based on company
-    filtered_allocations = []
-    for allocation in result['allocations']:
-        if company == 'A' or company == allocation['receiver']:
-            filtered_allocations.append(allocation)
+def render_visualization(company, result):
+    """
+    HTML dashboard of a calculate_output result as seen by one company.
+    """
+    # Address of the page's data, as a JavaScript string
+    data_url = json.dumps('/visualize_data?company=' + quote(company))
+
+    # Only the company's own numbers, see visualization_data
+    data = visualization_data(company, result)
 
     # Create HTML with embedded Chart.js visualization
     html = """
@@ -367,12 +910,12 @@ def visualize():
     </html>
     """
 
-    # Create different content based on company
-    if company == 'A':
+    # Create different content for suppliers and receivers
+    if 'allocations' in data:
         resource_summary = f"""
-            <p>Your available materials: <strong>{result['available_materials']}</strong></p>
-            <p>Total Storage Capacity of partners: <strong>{result['total_storage']}</strong></p>
-            <p>Total Requested Vaccines from partners: <strong>{result['total_requested']}</strong></p>
+            <p>Your available materials: <strong id="available_materials">{data['available_materials']}</strong></p>
+            <p>Total Storage Capacity of partners: <strong id="total_storage">{data['total_storage']}</strong></p>
+            <p>Total Requested Vaccines from partners: <strong id="total_requested">{data['total_requested']}</strong></p>
         """
 
         charts = f"""
@@ -382,7 +925,7 @@ def visualize():
 
         <script>
             // Parse allocation data
-            const allocations = {json.dumps(filtered_allocations)};
+            const allocations = {json.dumps(data['allocations'])};
 
             // Create chart showing distribution
             const distributionCtx = document.getElementById('distributionChart').getContext('2d');
@@ -427,18 +970,33 @@ def visualize():
                     }}
                 }}
             }});
+
+            // Update the chart from /visualize_data, unchanged data costs a 304
+            setInterval(async () => {{
+                const response = await fetch({data_url});
+                if (!response.ok) return;
+                const data = await response.json();
+                distributionChart.data.labels = data.allocations.map(a => 'Company ' + a.receiver);
+                distributionChart.data.datasets[0].data = data.allocations.map(a => a.requested);
+                distributionChart.data.datasets[1].data = data.allocations.map(a => a.capacity);
+                distributionChart.data.datasets[2].data = data.allocations.map(a => a["recommended vaccines to order from others"]);
+                distributionChart.update();
+                for (const key of ['available_materials', 'total_storage', 'total_requested']) {{
+                    document.getElementById(key).textContent = data[key];
+                }}
+            }}, 5000);
         </script>
         """
     else:
-        # For companies B or C, only show their own data
-        company_allocation = next((a for a in result['allocations'] if a['receiver'] == company), None)
+        # For receivers, only show their own data
+        company_allocation = data['allocation']
 
         if company_allocation:
             resource_summary = f"""
-                <p>Your storage capacity: <strong>{company_allocation['capacity']}</strong></p>
-                <p>Vaccines you requested: <strong>{company_allocation['requested']}</strong></p>
-                <p>Recommended vaccines to order from others: <strong>{company_allocation['recommended vaccines to order from others']}</strong></p>
-                <p>Your storage fill percentage: <strong>{company_allocation['fill_percentage']}%</strong></p>
+                <p>Your storage capacity: <strong id="capacity">{company_allocation['capacity']}</strong></p>
+                <p>Vaccines you requested: <strong id="requested">{company_allocation['requested']}</strong></p>
+                <p>Recommended vaccines to order from others: <strong id="recommended">{company_allocation['recommended vaccines to order from others']}</strong></p>
+                <p>Your storage fill percentage: <strong id="fill_percentage">{company_allocation['fill_percentage']}</strong>%</p>
             """
 
             charts = f"""
@@ -491,6 +1049,22 @@ def visualize():
                         }}
                     }}
                 }});
+
+                // Update the chart from /visualize_data, unchanged data costs a 304
+                setInterval(async () => {{
+                    const response = await fetch({data_url});
+                    if (!response.ok) return;
+                    const allocation = (await response.json()).allocation;
+                    if (!allocation) return;
+                    companyChart.data.datasets[0].data = [allocation.requested];
+                    companyChart.data.datasets[1].data = [allocation.capacity];
+                    companyChart.data.datasets[2].data = [allocation["recommended vaccines to order from others"]];
+                    companyChart.update();
+                    document.getElementById('capacity').textContent = allocation.capacity;
+                    document.getElementById('requested').textContent = allocation.requested;
+                    document.getElementById('recommended').textContent = allocation["recommended vaccines to order from others"];
+                    document.getElementById('fill_percentage').textContent = allocation.fill_percentage;
+                }}, 5000);
             </script>
             """
         else:
@@ -0,0 +1,105 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from quart import Quart, request, jsonify, make_response
+from main import cached_visualization, ledger
+
+# Async variant of the main.py API on the same ledger, for many concurrent
+# (polling) clients on one process. Run with e.g.
+#   hypercorn main_async:app
+# The event loop only parses requests and writes responses, every ledger call
+# runs on a thread pool so a slow disk read never blocks other connections.
+
+app = Quart(__name__)
+
+executor = ThreadPoolExecutor(max_workers=int(os.environ.get('LEDGER_IO_THREADS', 64)),
+                              thread_name_prefix='ledger-io')
+
+
+async def run_blocking(function, *args):
+    # Run a blocking ledger call on the I/O threads
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, partial(function, *args))
+
+
+@app.route('/')
+async def hello_world():
+    return 'Hello! This is the biomeds Holy Hack 2025 API.'
+
+@app.route('/add_company_data', methods=['POST'])
+async def add_company_data():
+    data = await request.get_json()
+    labels = data['labels']
+    account = data['account']
+    parameter = data['parameter']
+    amount = data['amount']
+
+    try:
+        await run_blocking(ledger.add_company_data, labels, account, parameter, amount)
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
+    return jsonify({"message": "Data added successfully"}), 200
+
+@app.route('/get_company_data', methods=['GET'])
+async def get_company_data():
+    account = request.args.get('account')
+    company = request.args.get('company')
+    search = request.args.get('search')
+    result = await run_blocking(ledger.get_company_data, account, company, search)
+    return jsonify({"data": result}), 200
+
+@app.route('/get_company_contract', methods=['GET'])
+async def get_company_contracts():
+    account = request.args.get('account')
+    company = request.args.get('company')
+    supplier = request.args.get('supplier')
+    receiver = request.args.get('receiver')
+
+    result = await run_blocking(ledger.get_company_contract, account, company, supplier, receiver)
+    return jsonify({"data": result}), 200
+
+@app.route('/get_result', methods=['GET'])
+async def get_result():
+    account = request.args.get('account')
+    result = await run_blocking(ledger.get_result, account)
+    return jsonify({"recommended vaccines": result}), 200
+
+@app.route('/visualize', methods=['GET'])
+async def visualize():
+    # Get company parameter from request
+    company = request.args.get('company')
+    if not company:
+        return "Please specify a company parameter (A, B, or C)", 400
+
+    # Rendered once per ledger version, browsers revalidate with the ETag
+    page = await run_blocking(cached_visualization, company)
+    return await conditional_response(page['html'], page['html_etag'], page['modified'], 'text/html')
+
+@app.route('/visualize_data', methods=['GET'])
+async def visualize_data():
+    # The numbers of the /visualize page, polled by the page to update its charts
+    company = request.args.get('company')
+    if not company:
+        return jsonify({"error": "Please specify a company parameter (A, B, or C)"}), 400
+
+    page = await run_blocking(cached_visualization, company)
+    return await conditional_response(page['data'], page['data_etag'], page['modified'], 'application/json')
+
+async def conditional_response(body, etag, modified, mimetype):
+    # 304 Not Modified when the client's ETag or date is still current
+    response = await make_response(body)
+    response.mimetype = mimetype
+    response.set_etag(etag)
+    response.last_modified = modified
+    response.cache_control.no_cache = True
+    return await response.make_conditional(request)
+
+
+@app.after_serving
+async def shutdown():
+    executor.shutdown(wait=False)
+
+
+if __name__ == '__main__':
+    app.run()
@@ -0,0 +1,170 @@
+import time
+from concurrent.futures import wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+from allocation import allocate
+from process_pool import pool_size, submit
+
+PERCENTILES = (5, 50, 95)
+
+# Bounds of a request, every batch costs a pickled copy of the ledger state
+MAX_SCENARIOS = 100000
+MIN_BATCH_SIZE = 50
+MAX_TIME_BUDGET = 30.0
+
+
+def disrupt(rng, values, n_scenarios, probability, max_loss):
+    """
+    Sample one disrupted copy of values per scenario.
+
+    Every company independently loses a uniform fraction of up to max_loss of
+    its value with the given probability.
+
+    Returns:
+        Array of shape (n_scenarios, n_companies)
+    """
+    shape = (n_scenarios, len(values))
+    hit = rng.random(shape) < probability
+    loss = rng.uniform(0, max_loss, shape)
+    return values * (1 - hit * loss)
+
+
+def run_batch(seed, n_scenarios, state, contracts, options, stop_at=None):
+    """
+    Allocate one batch of disrupted scenarios.
+
+    Args:
+        seed: numpy SeedSequence of this batch
+        n_scenarios: Number of scenarios in the batch
+        state: Arrays from OutputAggregates.arrays
+        contracts: Contract index per receiver column of the result
+        options: Disruption probabilities and maximum losses
+        stop_at: time.time() after which the batch is no longer needed
+
+    Returns:
+        Recommended vaccines to order, shape (n_scenarios, len(contracts)),
+        or None when the batch started after stop_at
+    """
+    if stop_at is not None and time.time() > stop_at:
+        return None
+    rng = np.random.default_rng(seed)
+    materials = disrupt(rng, state['materials'], n_scenarios,
+                        options['cut_probability'], options['max_cut'])
+    storage = disrupt(rng, state['storage'], n_scenarios,
+                      options['loss_probability'], options['max_loss'])
+    allocation = allocate(materials, storage, state['suppliers'], state['receivers'], state['requested'])
+    return allocation['recommended'][:, contracts]
+
+
+def simulate(state, scenarios=1000, seed=0, time_budget=2.0, batch_size=250,
+             cut_probability=0.1, max_cut=0.5, loss_probability=0.05, max_loss=0.3):
+    """
+    Monte Carlo estimate of the recommended vaccines to order per receiver
+    under sampled production disruptions.
+
+    Each scenario cuts the suppliers' materials and the receivers' storage at
+    random and runs the allocation of calculate_output on the result. The
+    scenarios are split into batches with their own seed, derived from seed,
+    and allocated in a process pool. Batches still running when the time
+    budget is spent are dropped; only the batches before the first missing
+    one are used, so the same seed and scenario count give the same numbers.
+    Batches are only handed to the pool while time is left, a few per
+    worker at a time.
+
+    Like Ledger.get_result, a receiver's recommendation comes from its last
+    allocated contract.
+
+    Args:
+        state: Arrays from OutputAggregates.arrays, the ledger is not touched
+        scenarios: Number of scenarios to sample, at most MAX_SCENARIOS
+        seed: Seed of the random generator
+        time_budget: Seconds to wait for the batches, at most MAX_TIME_BUDGET
+        batch_size: Scenarios per batch, at least MIN_BATCH_SIZE
+        cut_probability: Chance of a company losing materials in a scenario
+        max_cut: Largest fraction of materials lost
+        loss_probability: Chance of a company losing storage in a scenario
+        max_loss: Largest fraction of storage lost
+
+    Returns:
+        Dictionary with the number of scenarios requested and run, the seed
+        and the 'recommendations' per receiver: the undisrupted value plus
+        the mean and percentiles over the scenarios
+    """
+    if not 1 <= scenarios <= MAX_SCENARIOS:
+        raise ValueError(f"scenarios must be between 1 and {MAX_SCENARIOS}")
+    if batch_size < MIN_BATCH_SIZE:
+        raise ValueError(f"batch_size must be at least {MIN_BATCH_SIZE}")
+    if not 0 < time_budget <= MAX_TIME_BUDGET:
+        raise ValueError(f"time_budget must be above 0 and at most {MAX_TIME_BUDGET}")
+    for name, value in (('cut_probability', cut_probability), ('max_cut', max_cut),
+                        ('loss_probability', loss_probability), ('max_loss', max_loss)):
+        if not 0 <= value <= 1:
+            raise ValueError(f"{name} must be between 0 and 1")
+    options = {
+        'cut_probability': cut_probability,
+        'max_cut': max_cut,
+        'loss_probability': loss_probability,
+        'max_loss': max_loss
+    }
+
+    # Last allocated contract of every receiver, the disruptions never empty
+    # a storage completely so the allocated contracts stay the same
+    baseline = allocate(state['materials'], state['storage'],
+                        state['suppliers'], state['receivers'], state['requested'])
+    last_contract = {}
+    for contract in np.flatnonzero(baseline['allocated']).tolist():
+        last_contract[state['names'][state['receivers'][contract]]] = contract
+    receivers = list(last_contract)
+    contracts = np.array(list(last_contract.values()), dtype=np.int64)
+
+    sizes = [batch_size] * (scenarios // batch_size)
+    if scenarios % batch_size:
+        sizes.append(scenarios % batch_size)
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+
+    in_flight = 2 * pool_size()
+    deadline = time.monotonic() + time_budget
+    # Wall clock for the workers, their monotonic clocks may differ
+    stop_at = time.time() + time_budget
+    futures = []
+    pending = set()
+    while True:
+        while len(futures) < len(sizes) and len(pending) < in_flight and time.monotonic() < deadline:
+            number = len(futures)
+            future = submit(run_batch, seeds[number], sizes[number], state, contracts, options,
+                            stop_at)
+            futures.append(future)
+            pending.add(future)
+        remaining = deadline - time.monotonic()
+        if not pending or remaining <= 0:
+            break
+        done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+    for future in pending:
+        future.cancel()
+
+    batches = []
+    for future in futures:
+        if not future.done() or future.cancelled():
+            break
+        # Lost with a worker that died, the next simulation gets a new pool
+        if isinstance(future.exception(), BrokenProcessPool) or future.result() is None:
+            break
+        batches.append(future.result())
+    samples = np.concatenate(batches) if batches else np.empty((0, len(receivers)))
+
+    recommendations = {}
+    for column, receiver in enumerate(receivers):
+        recommendation = {'baseline': round(float(baseline['recommended'][contracts[column]]))}
+        if len(samples):
+            values = samples[:, column]
+            recommendation['mean'] = round(float(values.mean()), 2)
+            for percentile, value in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+                recommendation[f'p{percentile}'] = round(float(value))
+        recommendations[receiver] = recommendation
+
+    return {
+        'scenarios_requested': scenarios,
+        'scenarios_run': len(samples),
+        'seed': seed,
+        'recommendations': recommendations
+    }
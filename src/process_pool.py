@@ -0,0 +1,52 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# Most workers the pool starts, whatever the number of CPUs
+MAX_WORKERS = int(os.environ.get('PROCESS_POOL_SIZE', 4))
+
+pool = None
+pool_lock = threading.Lock()
+
+
+def pool_size():
+    return max(1, min(os.cpu_count() or 1, MAX_WORKERS))
+
+
+def get_pool():
+    """
+    Process pool of the ledger API, created on first use with pool_size()
+    workers.
+
+    Workers are forked where available, a spawned worker would re-run the
+    Flask app module and open the ledger a second time.
+    """
+    global pool
+    with pool_lock:
+        if pool is None:
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+            pool = ProcessPoolExecutor(max_workers=pool_size(), mp_context=context)
+        return pool
+
+
+def submit(function, *args):
+    """
+    Run function(*args) in the pool. A pool that broke because a worker
+    died is replaced by a new one.
+
+    Returns:
+        Future of the call
+    """
+    global pool
+    executor = get_pool()
+    try:
+        return executor.submit(function, *args)
+    except BrokenProcessPool:
+        with pool_lock:
+            if pool is executor:
+                pool = None
+        executor.shutdown(wait=False)
+        return get_pool().submit(function, *args)
@@ -0,0 +1,165 @@
+import threading
+from collections import deque
+from aggregates import parse_amount
+
+
+class SupplyGraph:
+    """
+    Supply chain built from the vaccine contracts, used to push production
+    shortfalls through every tier.
+
+    Each company distributes its own materials plus what it receives from its
+    suppliers over its outgoing contracts with the same rule as
+    allocation.allocate: proportional to the receivers' storage, capped at
+    what each contract requested. Companies are evaluated in topological
+    order, so a shortfall at the top reaches every company below it.
+
+    Changes only mark companies as dirty. The next read recomputes the dirty
+    companies and everything downstream of them, the rest of the graph keeps
+    its values. Contracts closing a cycle are evaluated once in insertion
+    order and not iterated to a fixed point.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset('contracts')
+        self.reset('data')
+
+    def reset(self, key):
+        if key == 'data':
+            self.materials = {}
+            self.storage = {}
+        else:
+            # [supplier, receiver, requested, delivered] per contract
+            self.outbound = {}
+            self.inbound = {}
+            self.available = {}
+            self.rank = None
+        self.dirty = set(self.outbound) | set(self.inbound)
+
+    def rebuild(self, key, rows):
+        # Replace the state of one ledger with the given rows
+        with self.lock:
+            self.reset(key)
+            for row in rows:
+                self.add(key, row)
+
+    def add_row(self, key, row):
+        with self.lock:
+            self.add(key, row)
+
+    def add(self, key, row):
+        if key == 'data':
+            if len(row) >= 5:
+                _, _, account, parameter, amount = row[:5]
+                if parameter not in ('materials', 'storage'):
+                    return
+                amount = parse_amount(key, row, amount)
+                if amount is None:
+                    return
+                if parameter == 'materials':
+                    self.materials[account] = amount
+                    self.dirty.add(account)
+                else:
+                    self.storage[account] = amount
+                    # Storage changes the share the suppliers send this company
+                    self.dirty.update(contract[0] for contract in self.inbound.get(account, ()))
+        elif len(row) >= 6:
+            _, _, supplier, receiver, parameter, value = row[:6]
+            if parameter == 'vaccines':
+                value = parse_amount(key, row, value)
+                if value is None:
+                    return
+                contract = [supplier, receiver, value, 0.0]
+                self.outbound.setdefault(supplier, []).append(contract)
+                self.inbound.setdefault(receiver, []).append(contract)
+                self.rank = None
+                self.dirty.add(supplier)
+
+    def topological_rank(self):
+        # Kahn's algorithm, companies left in a cycle are ranked last
+        companies = list(dict.fromkeys(list(self.outbound) + list(self.inbound)))
+        indegree = {company: 0 for company in companies}
+        for contracts in self.outbound.values():
+            for _, receiver, _, _ in contracts:
+                indegree[receiver] += 1
+        queue = deque(company for company in companies if indegree[company] == 0)
+        rank = {}
+        while queue:
+            company = queue.popleft()
+            rank[company] = len(rank)
+            for _, receiver, _, _ in self.outbound.get(company, ()):
+                indegree[receiver] -= 1
+                if indegree[receiver] == 0:
+                    queue.append(receiver)
+        for company in companies:
+            if company not in rank:
+                rank[company] = len(rank)
+        return rank
+
+    def downstream(self, companies):
+        seen = set(companies)
+        queue = deque(seen)
+        while queue:
+            for _, receiver, _, _ in self.outbound.get(queue.popleft(), ()):
+                if receiver not in seen:
+                    seen.add(receiver)
+                    queue.append(receiver)
+        return seen
+
+    def propagate(self):
+        """
+        Recompute the dirty companies and their downstream subgraph.
+
+        Returns:
+            Number of companies recomputed
+        """
+        if not self.dirty:
+            return 0
+        if self.rank is None:
+            self.rank = self.topological_rank()
+        affected = self.downstream(self.dirty)
+        last = len(self.rank)
+        for company in sorted(affected, key=lambda company: self.rank.get(company, last)):
+            self.recompute(company)
+        self.dirty = set()
+        return len(affected)
+
+    def recompute(self, company):
+        available = self.materials.get(company, 0) + sum(
+            contract[3] for contract in self.inbound.get(company, ()))
+        self.available[company] = available
+
+        contracts = self.outbound.get(company, ())
+        total_storage = sum(self.storage.get(receiver, 0)
+                            for receiver in {contract[1] for contract in contracts})
+        total_requested = sum(contract[2] for contract in contracts)
+        for contract in contracts:
+            if total_storage > 0 and total_requested > 0:
+                proportion = self.storage.get(contract[1], 0) / total_storage
+                contract[3] = min(available * proportion, contract[2])
+            else:
+                contract[3] = 0.0
+
+    def shortfall(self, company):
+        """
+        What a company can expect from its suppliers after propagation.
+
+        Returns:
+            Dictionary with the requested and expected inbound vaccines, the
+            shortfall between them and the company's available amount, or
+            None for a company without contracts
+        """
+        with self.lock:
+            self.propagate()
+            if company not in self.inbound and company not in self.outbound:
+                return None
+            contracts = self.inbound.get(company, ())
+            requested = sum(contract[2] for contract in contracts)
+            expected = sum(contract[3] for contract in contracts)
+            return {
+                'requested': requested,
+                'expected': expected,
+                'shortfall': requested - expected,
+                'available': self.available.get(company, 0)
+            }
@@ -0,0 +1,66 @@
+import threading
+from concurrent.futures import Future
+
+
+class VersionedCache:
+    """
+    Cache of one computed value, valid for one ledger version.
+
+    Readers asking for the current version share the cached value. When the
+    version moved on, the first reader recomputes and concurrent readers of
+    the same version wait for that result instead of computing it again.
+    The cached value is shared, callers must not modify it.
+
+    Args:
+        compute: Function without arguments that produces the value
+    """
+
+    def __init__(self, compute):
+        self.compute = compute
+        self.lock = threading.Lock()
+        self.version = None
+        self.value = None
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, version):
+        with self.lock:
+            if self.version == version:
+                self.hits += 1
+                return self.value
+            future = self.pending.get(version)
+            owner = future is None
+            if owner:
+                self.misses += 1
+                future = self.pending[version] = Future()
+            else:
+                self.coalesced += 1
+        if not owner:
+            return future.result()
+
+        try:
+            value = self.compute()
+        except Exception as error:
+            with self.lock:
+                del self.pending[version]
+            future.set_exception(error)
+            raise
+        with self.lock:
+            del self.pending[version]
+            # A slow computation must not replace the value of a newer version
+            if self.version is None or version > self.version:
+                self.version = version
+                self.value = value
+        future.set_result(value)
+        return value
+
+    def stats(self):
+        with self.lock:
+            return {
+                'version': self.version,
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced
+            }
@@ -0,0 +1,47 @@
+import csv
+import os
+
+
+def parse_row(line):
+    # Fields of one raw ledger line
+    return next(csv.reader([line.decode()]), [])
+
+
+def reverse_csv_reader(filename, block_size=64 * 1024, skip_header=True, start=0, end=None):
+    """
+    Yield the rows of a CSV ledger newest-first.
+
+    The file is read backwards in fixed-size blocks, so memory use only depends
+    on block_size and a caller that stops early only reads the tail of the file.
+    Quoted fields spanning several lines are not supported, the ledgers
+    reject line breaks in the values they write.
+
+    Args:
+        filename: Path of the CSV file, or a file opened in binary mode
+                  that is closed once the rows are read
+        block_size: Number of bytes read per step
+        skip_header: Do not yield the first line of the file
+        start: Byte offset of the first row to read, rows before it are
+               never touched. The header is only skipped when start is 0.
+        end: Byte offset where the rows end, None for the end of the file
+
+    Returns:
+        Generator of rows, last row first
+    """
+    file = open(filename, mode='rb') if isinstance(filename, (str, os.PathLike)) else filename
+    with file:
+        position = file.seek(0, os.SEEK_END) if end is None else end
+        remainder = b''
+        while position > start:
+            read_size = min(block_size, position - start)
+            position -= read_size
+            file.seek(position)
+            lines = (file.read(read_size) + remainder).split(b'\n')
+            # The first piece may start in the middle of a line, keep it for
+            # the next (earlier) block
+            remainder = lines.pop(0)
+            for line in reversed(lines):
+                if line.strip(b'\r'):
+                    yield parse_row(line)
+        if remainder.strip(b'\r') and (start > 0 or not skip_header):
+            yield parse_row(remainder)
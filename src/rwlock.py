@@ -0,0 +1,124 @@
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: only the locking inside the process applies
+    fcntl = None
+
+
+class LockSide:
+    # Reusable context manager around an acquire and a release function
+    def __init__(self, acquire, release):
+        self.acquire = acquire
+        self.release = release
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class RWLock:
+    """
+    Reader-writer lock for the threads of one process.
+
+    Any number of readers or a single writer. Waiting writers go first, so a
+    steady stream of readers cannot starve them. The thread holding the
+    write side may take either side again, e.g. a listener that reads the
+    ledger while a write notifies it. A reader must not ask for the write
+    side.
+
+    Use as `with lock.reader:` or `with lock.writer:`.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.owner = None
+        self.depth = 0
+        self.waiting_writers = 0
+        self.reader = LockSide(self.acquire_read, self.release_read)
+        self.writer = LockSide(self.acquire_write, self.release_write)
+
+    def acquire_read(self):
+        with self.condition:
+            if self.owner == threading.get_ident():
+                self.depth += 1
+                return
+            while self.owner is not None or self.waiting_writers:
+                self.condition.wait()
+            self.readers += 1
+
+    def release_read(self):
+        with self.condition:
+            if self.owner == threading.get_ident():
+                self.depth -= 1
+                return
+            self.readers -= 1
+            if self.readers == 0:
+                self.condition.notify_all()
+
+    def acquire_write(self):
+        with self.condition:
+            if self.owner == threading.get_ident():
+                self.depth += 1
+                return
+            self.waiting_writers += 1
+            while self.owner is not None or self.readers:
+                self.condition.wait()
+            self.waiting_writers -= 1
+            self.owner = threading.get_ident()
+            self.depth = 1
+
+    def release_write(self):
+        with self.condition:
+            self.depth -= 1
+            if self.depth == 0:
+                self.owner = None
+                self.condition.notify_all()
+
+
+class FileLock:
+    """
+    Exclusive advisory lock shared by all processes that use the same file.
+
+    Uses flock on a separate lock file, so it never blocks plain readers of
+    the ledger itself. The lock is held per process, take it only under an
+    RWLock writer. Nested acquires are counted. Without fcntl it does nothing.
+
+    Args:
+        filename: Lock file, created when missing
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = None
+        self.depth = 0
+
+    def acquire(self):
+        self.depth += 1
+        if self.depth > 1 or fcntl is None:
+            return
+        if self.file is None:
+            self.file = open(self.filename, mode='a')
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+
+    def release(self):
+        self.depth -= 1
+        if self.depth == 0 and fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
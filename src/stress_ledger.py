@@ -0,0 +1,179 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+from ledger_storage import CsvStorage, SqliteStorage
+
+
+class SequenceChecker:
+    """
+    Storage listener that checks every writer's rows arrive complete, once
+    and in order. Writers store 1, 2, 3, ... as the amount of their account.
+    """
+
+    def __init__(self):
+        self.last = {}
+        self.rows = 0
+        self.errors = []
+
+    def row_added(self, key, row):
+        self.rows += 1
+        if len(row) != 5 or not row[4].isdigit():
+            self.errors.append(f"torn row {row}")
+            return
+        expected = self.last.get(row[2], 0) + 1
+        if int(row[4]) != expected:
+            self.errors.append(f"{row[2]}: got {row[4]}, expected {expected}")
+        self.last[row[2]] = int(row[4])
+
+    def ledger_reset(self, key):
+        self.errors.append(f"unexpected reset of {key}")
+
+
+def open_storage(kind, directory):
+    if kind == 'sqlite':
+        return SqliteStorage(os.path.join(directory, 'ledger.db'))
+    return CsvStorage(os.path.join(directory, 'ledger_Data.csv'),
+                      os.path.join(directory, 'ledger_Contracts.csv'))
+
+
+def check_row(row, errors):
+    if len(row) != 5 or not row[4].isdigit():
+        errors.append(f"torn read {row}")
+
+
+def write_rows(storage, account, rows, batch):
+    sequence = 1
+    while sequence <= rows:
+        amounts = range(sequence, min(sequence + batch, rows + 1))
+        timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
+        storage.append_data_many([[timestamp, f"{{'{account}'}}", account, 'materials', amount]
+                                  for amount in amounts])
+        sequence += len(amounts)
+
+
+def read_rows(storage, accounts, done, errors):
+    reads = 0
+    while not done.is_set():
+        for account in accounts:
+            for row in storage.find_data(account, 'materials'):
+                check_row(row, errors)
+                break
+            reads += 1
+        if reads % 20 == 0:
+            for row in storage.iter_data():
+                check_row(row, errors)
+    return reads
+
+
+def worker(number, kind, directory, threads, rows, batch, barrier, results):
+    storage = open_storage(kind, directory)
+    checker = SequenceChecker()
+    # Rows already written by processes that started earlier
+    for row in storage.iter_data():
+        checker.row_added('data', row)
+    storage.listeners.append(checker)
+
+    accounts = [f"P{number}T{thread}" for thread in range(threads)]
+    all_accounts = [f"P{process}T{thread}" for process in range(barrier.parties)
+                    for thread in range(threads)]
+    read_errors = []
+    done = threading.Event()
+    writers = [threading.Thread(target=write_rows, args=(storage, account, rows, batch))
+               for account in accounts]
+    readers = [threading.Thread(target=read_rows, args=(storage, all_accounts, done, read_errors))
+               for _ in range(threads)]
+    for thread in writers + readers:
+        thread.start()
+    for thread in writers:
+        thread.join()
+    # Every process has written all its rows
+    barrier.wait()
+    done.set()
+    for thread in readers:
+        thread.join()
+
+    storage.refresh()
+    errors = checker.errors + read_errors
+    for account in all_accounts:
+        if checker.last.get(account) != rows:
+            errors.append(f"{account}: saw {checker.last.get(account)} of {rows} rows")
+    storage.close()
+    results.put((number, checker.rows, errors[:10], len(errors)))
+
+
+def run_stress(kind='csv', processes=4, threads=4, rows=500, batch=5):
+    """
+    Write and read one ledger from several processes at once, then read it
+    back from a new process.
+
+    Returns:
+        Dict with the reports of the processes as (number, rows seen, first
+        errors, error count), the rows and errors of the ledger read back,
+        the number of rows expected and the seconds taken
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        open_storage(kind, directory).close()
+        context = multiprocessing.get_context()
+        barrier = context.Barrier(processes)
+        results = context.Queue()
+        workers = [context.Process(target=worker, args=(number, kind, directory, threads, rows,
+                                                       batch, barrier, results))
+                   for number in range(processes)]
+        started = time.monotonic()
+        for process in workers:
+            process.start()
+        reports = [results.get() for _ in workers]
+        for process in workers:
+            process.join()
+        elapsed = time.monotonic() - started
+
+        # The ledger itself, read back by a new process
+        checker = SequenceChecker()
+        storage = open_storage(kind, directory)
+        for row in storage.iter_data():
+            checker.row_added('data', row)
+        storage.close()
+
+    return {
+        'processes': sorted(reports),
+        'rows': checker.rows,
+        'errors': checker.errors,
+        'expected': processes * threads * rows,
+        'seconds': elapsed
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Hammer one ledger with concurrent writers and readers in several processes "
+                    "and check that no row is torn, lost or duplicated.")
+    parser.add_argument('--storage', choices=('csv', 'sqlite'), default='csv')
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=4, help="writer and reader threads per process")
+    parser.add_argument('--rows', type=int, default=500, help="rows per writer")
+    parser.add_argument('--batch', type=int, default=5, help="rows per append")
+    args = parser.parse_args()
+
+    report = run_stress(args.storage, args.processes, args.threads, args.rows, args.batch)
+    failed = False
+    for number, seen, errors, error_count in report['processes']:
+        print(f"process {number}: {seen} rows seen, {error_count} errors")
+        for error in errors:
+            print(f"    {error}")
+        failed = failed or error_count > 0
+
+    print(f"ledger: {report['rows']} of {report['expected']} rows, {len(report['errors'])} errors, "
+          f"{report['seconds']:.1f}s")
+    for error in report['errors'][:10]:
+        print(f"    {error}")
+    failed = failed or report['errors'] or report['rows'] != report['expected']
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
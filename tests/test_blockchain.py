@@ -0,0 +1,189 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'Blockchain'))
+
+from block import Block, Entry
+from block_store import BlockStore
+from merkle import merkle_proof, merkle_root, verify_proof
+from verify import ChainAuditor
+
+
+def entry(data):
+    return Entry(data, 'owner', ['owner'], ['owner'], timestamp=1.0)
+
+
+def store_chain(filename, sizes):
+    # A BlockStore holding a genesis block and one block per size
+    store = BlockStore(filename, encode=Block.to_dict, decode=Block.from_dict, sync=False)
+    store.append(Block(0, "0", [entry("GENESIS")], timestamp=0.0))
+    for size in sizes:
+        entries = [entry(f"{len(store)}-{number}") for number in range(size)]
+        store.append(Block(len(store), store[-1].hash, entries, timestamp=float(len(store))))
+    return store
+
+
+def open_store(filename):
+    return BlockStore(filename, encode=Block.to_dict, decode=Block.from_dict, sync=False)
+
+
+@pytest.mark.parametrize('size', range(1, 10))
+def test_merkle_proofs(size):
+    leaves = [entry(str(number)).hash for number in range(size)]
+    root = merkle_root(leaves)
+    for position, leaf in enumerate(leaves):
+        assert verify_proof(leaf, merkle_proof(leaves, position), root)
+    assert not verify_proof(entry('other').hash, merkle_proof(leaves, 0), root)
+
+
+def test_duplicated_last_leaf_changes_the_root():
+    leaves = [entry(str(number)).hash for number in range(5)]
+    assert merkle_root(leaves) != merkle_root(leaves + leaves[-1:])
+    # An inner node is not accepted as a leaf
+    levels_root = merkle_root(leaves[:2])
+    assert merkle_root([levels_root]) != levels_root
+
+
+def test_audit_detects_a_duplicated_entry(tmp_path):
+    filename = str(tmp_path / 'chain.blocks')
+    store_chain(filename, [5]).close()
+    assert ChainAuditor(open_store(filename), filename).audit(full=True)['valid']
+
+    # Append a copy of the last entry to block 1, the index is rebuilt on open
+    with open(filename, 'rb') as file:
+        lines = file.read().splitlines(keepends=True)
+    record = json.loads(lines[1])
+    record['entries'].append(record['entries'][-1])
+    lines[1] = json.dumps(record, separators=(',', ':')).encode() + b'\n'
+    with open(filename, 'wb') as file:
+        file.writelines(lines)
+    os.remove(filename + '.idx')
+
+    result = ChainAuditor(open_store(filename)).audit(full=True)
+    assert not result['valid']
+    assert result['failure']['index'] == 1
+
+
+def test_recover_cuts_a_torn_last_block(tmp_path):
+    filename = str(tmp_path / 'chain.blocks')
+    store = store_chain(filename, [2, 3])
+    hashes = [block.hash for block in store]
+    size = os.path.getsize(filename)
+    store.close()
+
+    # A block written halfway, before its offset reached the index
+    with open(filename, 'ab') as file:
+        file.write(b'{"index":3,"prev_hash":"')
+    store = open_store(filename)
+    assert len(store) == 3
+    assert [block.hash for block in store] == hashes
+    assert os.path.getsize(filename) == size
+
+    # Appends go on after the cut
+    store.append(Block(3, store[-1].hash, [entry("after")], timestamp=3.0))
+    store.close()
+    store = open_store(filename)
+    assert len(store) == 4
+    assert ChainAuditor(store).audit(full=True)['valid']
+
+
+def test_recover_completes_an_index_behind_the_block_file(tmp_path):
+    filename = str(tmp_path / 'chain.blocks')
+    store = store_chain(filename, [1, 2, 3])
+    hashes = [block.hash for block in store]
+    store.close()
+
+    # Crash after writing the blocks but before the last two offsets
+    index_size = os.path.getsize(filename + '.idx')
+    with open(filename + '.idx', 'r+b') as file:
+        file.truncate(index_size - 2 * 8)
+    store = open_store(filename)
+    assert [block.hash for block in store] == hashes
+    assert os.path.getsize(filename + '.idx') == index_size
+    store.close()
+
+    # A torn offset is dropped and completed as well
+    with open(filename + '.idx', 'r+b') as file:
+        file.truncate(index_size - 3)
+    store = open_store(filename)
+    assert [block.hash for block in store] == hashes
+    store.close()
+
+
+def reader_index(filename):
+    from reader_index import ReaderIndex
+    store = open_store(filename)
+    readers = ReaderIndex(store, filename)
+    readers.build()
+    return store, readers
+
+
+def test_reader_index_is_loaded_and_caught_up(tmp_path):
+    filename = str(tmp_path / 'chain.blocks')
+    store_chain(filename, [1, 1]).close()
+    store, readers = reader_index(filename)
+    assert readers.get('owner') == [0, 1, 2]
+    readers.file.close()
+    store.close()
+
+    # Blocks sealed while the index was not built are read from the chain
+    store = open_store(filename)
+    store.append(Block(3, store[-1].hash, [entry("later")], timestamp=3.0))
+    store.close()
+    store, readers = reader_index(filename)
+    assert readers.get('owner') == [0, 1, 2, 3]
+    with open(filename + '.readers') as file:
+        assert len(file.readlines()) == 4
+    readers.file.close()
+    store.close()
+
+
+def test_reader_index_rejects_a_mismatched_hash(tmp_path):
+    filename = str(tmp_path / 'chain.blocks')
+    store_chain(filename, [1, 1]).close()
+    store, readers = reader_index(filename)
+    readers.file.close()
+    store.close()
+
+    # The block file is replaced by another chain of the same length
+    for name in (filename, filename + '.idx'):
+        os.remove(name)
+    store = BlockStore(filename, encode=Block.to_dict, decode=Block.from_dict, sync=False)
+    store.append(Block(0, "0", [Entry("GENESIS", "other", ['other'], ['other'], timestamp=0.0)],
+                       timestamp=0.0))
+    for number in (1, 2):
+        store.append(Block(number, store[-1].hash,
+                           [Entry(str(number), 'other', ['other'], ['other'], timestamp=1.0)],
+                           timestamp=float(number)))
+    store.close()
+
+    store, readers = reader_index(filename)
+    assert readers.get('owner') == []
+    assert readers.get('other') == [0, 1, 2]
+    with open(filename + '.readers', 'rb') as file:
+        assert [json.loads(line)[1] for line in file] == [block.hash for block in store]
+    readers.file.close()
+    store.close()
+
+
+def test_reader_index_cuts_a_torn_line(tmp_path):
+    filename = str(tmp_path / 'chain.blocks')
+    store_chain(filename, [1, 1]).close()
+    store, readers = reader_index(filename)
+    readers.file.close()
+    store.close()
+
+    with open(filename + '.readers', 'rb') as file:
+        lines = file.readlines()
+    with open(filename + '.readers', 'wb') as file:
+        file.writelines(lines[:2])
+        file.write(lines[2][:10])
+    store, readers = reader_index(filename)
+    assert readers.get('owner') == [0, 1, 2]
+    with open(filename + '.readers', 'rb') as file:
+        assert file.readlines() == lines
+    readers.file.close()
+    store.close()
@@ -0,0 +1,116 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from labels import parse_labels
+
+
+@pytest.fixture
+def ledger(tmp_path, monkeypatch):
+    # Importing main opens the API's own ledger in the working directory
+    monkeypatch.chdir(tmp_path)
+    import main
+    return main.Ledger(str(tmp_path / 'ledger.csv'))
+
+
+def original_output(data_rows, contract_rows):
+    # calculate_output as it was before the aggregates, for supplier A and
+    # receivers B and C only
+    company_a_data = {}
+    company_b_data = {}
+    company_c_data = {}
+    for row in data_rows:
+        if len(row) >= 5:
+            _, labels_str, account, parameter, amount = row[:5]
+            labels = parse_labels(labels_str)
+            if 'A' in labels and parameter == 'materials':
+                company_a_data['materials'] = float(amount)
+            elif 'B' in labels and parameter == 'storage':
+                company_b_data['storage'] = float(amount)
+            elif 'C' in labels and parameter == 'storage':
+                company_c_data['storage'] = float(amount)
+
+    contracts = []
+    for row in contract_rows:
+        if len(row) >= 6:
+            _, labels_str, supplier, receiver, parameter, value = row[:6]
+            if supplier == 'A' and parameter == 'vaccines':
+                contracts.append({'supplier': supplier, 'receiver': receiver, 'requested': float(value)})
+
+    available_materials = company_a_data.get('materials', 0)
+    total_storage = company_b_data.get('storage', 0) + company_c_data.get('storage', 0)
+    total_requested = sum(c['requested'] for c in contracts)
+    results = []
+    if total_storage > 0 and total_requested > 0:
+        for contract in contracts:
+            receiver = contract['receiver']
+            requested = contract['requested']
+            if receiver == 'B':
+                storage_capacity = company_b_data.get('storage', 0)
+            elif receiver == 'C':
+                storage_capacity = company_c_data.get('storage', 0)
+            else:
+                storage_capacity = 0
+            proportion = storage_capacity / total_storage
+            fair_amount = min(available_materials * proportion, requested)
+            results.append({
+                'receiver': receiver,
+                'requested': requested,
+                'recommended vaccines to order from others': storage_capacity - round(fair_amount, 0),
+                'capacity': storage_capacity,
+                'fill_percentage': round((fair_amount / storage_capacity * 100 if storage_capacity > 0 else 0), 2)
+            })
+    return {
+        'available_materials': available_materials,
+        'total_storage': total_storage,
+        'total_requested': total_requested,
+        'allocations': results
+    }
+
+
+@pytest.mark.parametrize('materials, storage_b, storage_c, requested_b, requested_c', [
+    (300, 200, 100, 400, 200),
+    (1000, 200, 100, 400, 200),
+    (500, 300, 300, 100, 900),
+    (0, 200, 100, 400, 200),
+])
+def test_abc_matches_the_original(ledger, materials, storage_b, storage_c, requested_b, requested_c):
+    ledger.add_company_data(['A'], 'A', 'materials', materials)
+    ledger.add_company_data(['B'], 'B', 'storage', storage_b)
+    ledger.add_company_data(['C'], 'C', 'storage', storage_c)
+    ledger.add_company_contract(['A', 'B'], 'A', 'B', 'vaccines', requested_b)
+    ledger.add_company_contract(['A', 'C'], 'A', 'C', 'vaccines', requested_c)
+
+    expected = original_output(ledger.storage.export('data')[0], ledger.storage.export('contracts')[0])
+    result = ledger.calculate_output(verify=True)
+    for key in ('available_materials', 'total_storage', 'total_requested'):
+        assert result[key] == expected[key]
+    allocations = [{key: value for key, value in allocation.items() if key != 'supplier'}
+                   for allocation in result['allocations']]
+    assert allocations == expected['allocations']
+    assert ledger.get_recommendations() == {
+        allocation['receiver']: round(allocation['recommended vaccines to order from others'])
+        for allocation in expected['allocations']}
+
+
+def test_allocation_lookups_match_the_records(ledger):
+    for supplier, receiver, value in [('A', 'B', 400), ('A', 'C', 200), ('D', 'B', 50), ('A', 'B', 25)]:
+        ledger.add_company_contract([supplier, receiver], supplier, receiver, 'vaccines', value)
+    for company, parameter, amount in [('A', 'materials', 300), ('D', 'materials', 40),
+                                       ('B', 'storage', 200), ('C', 'storage', 100)]:
+        ledger.add_company_data([company], company, parameter, amount)
+
+    allocations = ledger.calculate_output()['allocations']
+    records = list(allocations)
+    assert len(records) == 4
+    for company in ('A', 'B', 'C', 'D', 'X'):
+        assert allocations.where('supplier', company) == [a for a in records if a['supplier'] == company]
+        assert allocations.where('receiver', company) == [a for a in records if a['receiver'] == company]
+    last = {}
+    for allocation in records:
+        last[allocation['receiver']] = allocation['recommended vaccines to order from others']
+    assert allocations.recommended_by_receiver() == last
+    assert list(allocations.recommended_by_receiver()) == list(last)
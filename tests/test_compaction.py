@@ -0,0 +1,123 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+ACCOUNTS = ['A', 'B', 'C', 'D', 'E', 'X']
+PARAMETERS = ['materials', 'storage']
+
+
+@pytest.fixture
+def ledger_class(tmp_path, monkeypatch):
+    # Importing main opens the API's own ledger in the working directory
+    monkeypatch.chdir(tmp_path)
+    import main
+    return main.Ledger
+
+
+def fill(ledger):
+    ledger.add_company_data(['A'], 'A', 'materials', 500)
+    ledger.add_company_data(['A'], 'A', 'materials', 450)
+    ledger.add_company_data(['B'], 'B', 'storage', 300)
+    ledger.add_company_data(['C'], 'C', 'storage', 200)
+    # An older row only D may read, then a newer one only E may read
+    ledger.add_company_data(['D', 'E'], 'E', 'storage', 80)
+    ledger.add_company_data(['E'], 'E', 'storage', 90)
+    ledger.add_company_contract("['A', 'B']", 'A', 'B', 'vaccines', 400)
+    ledger.add_company_contract("['A', 'C']", 'A', 'C', 'vaccines', 200)
+    ledger.add_company_contract("['A', 'B']", 'A', 'B', 'delivery', 5)
+    ledger.add_company_contract("['A', 'B']", 'A', 'B', 'vaccines', 100)
+    ledger.add_company_contract("['A', 'B']", 'A', 'B', 'delivery', 6)
+    ledger.add_company_contract("['B']", 'A', 'B', 'delivery', 7)
+    ledger.add_company_contract("['C', 'E']", 'C', 'E', 'vaccines', 50)
+
+
+def results(ledger):
+    # Every query whose answer compaction could change
+    answers = {'output': ledger.calculate_output(verify=True)}
+    for account in ACCOUNTS:
+        for company in ACCOUNTS:
+            for parameter in PARAMETERS:
+                answers[('data', account, company, parameter)] = ledger.get_company_data(
+                    account, company, parameter)
+            for filters in [(company, None, None), (None, company, None), (None, None, company),
+                            (None, 'A', company)]:
+                answers[('contract', account) + filters] = ledger.get_company_contract(account, *filters)
+    for company in ACCOUNTS:
+        answers[('shortfall', company)] = ledger.get_shortfall(company)
+    return answers
+
+
+@pytest.mark.parametrize('archive', [True, False])
+def test_compaction_keeps_results(ledger_class, tmp_path, archive):
+    filename = str(tmp_path / 'ledger.csv')
+    ledger = ledger_class(filename)
+    fill(ledger)
+    before = results(ledger)
+    assert before['output']['allocations']
+    assert before[('data', 'D', 'E', 'storage')][4] == '80'
+
+    ledger.compact(archive=archive)
+    assert results(ledger) == before
+
+    # A restart only reads the snapshot and the tail
+    assert results(ledger_class(filename)) == before
+
+    # Rows written after the compaction are added to the snapshot's
+    ledger.add_company_contract("['A', 'B']", 'A', 'B', 'vaccines', 25)
+    ledger.add_company_data(['D'], 'E', 'storage', 70)
+    after_write = results(ledger)
+    ledger.compact(archive=archive)
+    assert results(ledger) == after_write
+
+
+@pytest.mark.parametrize('archive', [True, False])
+def test_compaction_keeps_history(ledger_class, tmp_path, archive):
+    filename = str(tmp_path / 'ledger.csv')
+    ledger = ledger_class(filename)
+    fill(ledger)
+    history = {company: ledger.get_company_history(company, company, 'storage')
+               for company in ACCOUNTS}
+    assert len(history['E'][0]) == 2
+    seen_by_d = ledger.get_company_history('D', 'E', 'storage')
+    assert len(seen_by_d[0]) == 1
+
+    ledger.compact(archive=archive)
+    ledger.add_company_data(['E'], 'E', 'storage', 95)
+    ledger.compact(archive=archive)
+    for reopened in (ledger, ledger_class(filename)):
+        rows, _ = reopened.get_company_history('E', 'E', 'storage')
+        assert [row[4] for row in rows] == ['80', '90', '95']
+        assert reopened.get_company_history('D', 'E', 'storage') == seen_by_d
+        assert reopened.get_company_history('B', 'B', 'storage') == history['B']
+
+
+@pytest.mark.parametrize('archive', [True, False])
+def test_import_after_compaction(ledger_class, tmp_path, archive):
+    from ledger_storage import CsvStorage, SqliteStorage
+    data_filename = str(tmp_path / 'ledger_Data.csv')
+    storage = CsvStorage(data_filename, str(tmp_path / 'ledger_Contracts.csv'))
+    database = SqliteStorage(str(tmp_path / 'ledger.db'))
+
+    def add(first, count):
+        storage.append_data_many([['2025-01-01 00:00:00', "{'A'}", 'A', 'storage', str(number)]
+                                  for number in range(first, first + count)])
+
+    add(0, 50)
+    assert database.import_csv(data_filename, 'data') == 50
+    storage.compact(archive=archive)
+    add(50, 100)
+    assert database.import_csv(data_filename, 'data') == 100
+    storage.compact(archive=archive)
+    add(150, 10)
+    assert database.import_csv(data_filename, 'data') == 10
+    assert [int(row[4]) for row in database.iter_data()] == list(range(160))
+
+    # The rows imported last were cleared, they cannot be matched any more
+    storage.clear('data')
+    with pytest.raises(ValueError):
+        database.import_csv(data_filename, 'data')
+    storage.close()
+    database.close()
@@ -0,0 +1,106 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+
+@pytest.fixture
+def main(tmp_path, monkeypatch):
+    # Importing main opens the API's own ledger in the working directory
+    monkeypatch.chdir(tmp_path)
+    import main
+    # The routes use a ledger of their own per test
+    monkeypatch.setattr(main, 'ledger', main.Ledger(str(tmp_path / 'api.csv')))
+    return main
+
+
+@pytest.mark.parametrize('parameter', ["p\n2025-01-01 00:00:00,{'A'},A,materials,1,x", "stor\r\nage"])
+def test_line_breaks_are_rejected(main, tmp_path, parameter):
+    filename = str(tmp_path / 'ledger.csv')
+    ledger = main.Ledger(filename)
+    ledger.add_company_data(['B'], 'B', 'storage', 300)
+    with pytest.raises(ValueError):
+        ledger.add_company_data(['X'], 'X', parameter, 5)
+    with pytest.raises(ValueError):
+        ledger.add_company_contract("['A', 'B']", 'A', 'B\n', 'vaccines', 5)
+    with pytest.raises(ValueError):
+        ledger.add_company_data(['X'], 'X', 'storage', '5\n')
+
+    # The ledger still opens and holds only the valid row
+    reopened = main.Ledger(filename)
+    assert reopened.get_company_data('B', 'B', 'storage')[4] == '300'
+    assert reopened.get_company_data('X', 'X', 'storage') == "Not found"
+
+
+def test_routes_answer_400(main):
+    client = main.app.test_client()
+    response = client.post('/add_company_data', json={
+        'labels': ['X'], 'account': 'X\n', 'parameter': 'storage', 'amount': 5})
+    assert response.status_code == 400
+    # Bulk requests reject the record and keep the others
+    response = client.post('/add_company_data_bulk', data='[{"labels": ["X"], "account": "X", '
+                           '"parameter": "stor\\nage", "amount": 5}]')
+    assert response.get_json()['rejected'] == 1
+    assert 'line breaks' in response.get_json()['rows'][0]['error']
+
+
+def test_longer_rows_are_read(main, tmp_path):
+    filename = str(tmp_path / 'ledger.csv')
+    ledger = main.Ledger(filename)
+    ledger.add_company_data(['A'], 'A', 'materials', 300)
+    ledger.add_company_data(['B'], 'B', 'storage', 200)
+    ledger.add_company_contract("['A', 'B']", 'A', 'B', 'vaccines', 400)
+    # Rows with extra columns, e.g. written by another tool
+    data_filename, contracts_filename = ledger.storage.data_filename, ledger.storage.contracts_filename
+    with open(data_filename, 'a') as file:
+        file.write("2025-01-01 00:00:00,{'C'},C,storage,100,extra\n")
+    with open(contracts_filename, 'a') as file:
+        file.write("2025-01-01 00:00:00,\"['A', 'C']\",A,C,vaccines,50,extra\n")
+
+    reopened = main.Ledger(filename)
+    output = reopened.calculate_output(verify=True)
+    assert output['total_storage'] == 300
+    assert reopened.get_shortfall('C')['requested'] == 50
+
+
+@pytest.mark.parametrize('amount', ['NaN', 'Infinity', '-Infinity', 'true', '"5"'])
+def test_bulk_rejects_non_finite_amounts(main, amount):
+    client = main.app.test_client()
+    response = client.post('/add_company_data_bulk', data='[{"labels": ["X"], "account": "X", '
+                           f'"parameter": "storage", "amount": {amount}}}]')
+    assert response.get_json()['rejected'] == 1
+    assert client.get('/get_result').status_code == 200
+    main.ledger.calculate_output(verify=True)
+
+
+def test_failed_recommendation_write_is_retried(main, tmp_path):
+    import threading
+    import time
+    ledger = main.Ledger(str(tmp_path / 'ledger.csv'))
+    ledger.add_company_data(['A'], 'A', 'materials', 300)
+    ledger.add_company_data(['B'], 'B', 'storage', 200)
+    ledger.add_company_contract("['A', 'B']", 'A', 'B', 'vaccines', 400)
+
+    failed = threading.Event()
+    append_data = ledger.storage.append_data
+
+    def fail_once(row):
+        if row[3] == 'recommended_vaccines_to_order' and not failed.is_set():
+            failed.set()
+            raise OSError("disk full")
+        return append_data(row)
+
+    ledger.storage.append_data = fail_once
+    recommendations = ledger.get_recommendations()
+    assert failed.wait(5)
+
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        assert ledger.get_recommendations() == recommendations
+        row = next(ledger.storage.find_data('B', 'recommended_vaccines_to_order'), None)
+        if row is not None:
+            break
+        time.sleep(0.01)
+    assert float(row[4]) == recommendations['B']
@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from stress_ledger import run_stress
+
+
+@pytest.mark.parametrize('kind', ['csv', 'sqlite'])
+def test_concurrent_writers_and_readers(kind):
+    # A scaled-down run of stress_ledger.py, see there for the full one
+    report = run_stress(kind, processes=2, threads=2, rows=100, batch=5)
+    for number, seen, errors, error_count in report['processes']:
+        assert error_count == 0, errors
+    assert report['errors'] == []
+    assert report['rows'] == report['expected']